@@ -20,7 +20,7 @@ from blueberrypy import shell
 
 from blueberrypy.config import BlueberryPyConfiguration
 from blueberrypy.project import create_project
-from blueberrypy.template_engine import configure_jinja2
+from blueberrypy.template_engine import configure_jinja2, compile_templates, warm_bytecode_cache
 from blueberrypy.exc import BlueberryPyNotConfiguredError
 
 
@@ -222,6 +222,79 @@ def bundle(**kwargs):
         assets_cli.clean()
 
 
+def templates(**kwargs):
+    """
+    Jinja2 template management.
+
+    usage: blueberrypy templates warm [options]
+           blueberrypy templates compile [options] [TARGET]
+
+    The 'warm' command compiles all the templates into the configured Jinja2
+    bytecode cache, so that a cache shared by several processes or hosts, such
+    as blueberrypy.template_engine.RedisBytecodeCache, can be populated
+    before they start. The Redis sessions are set up first, if configured, as
+    such a cache may use their connection.
+
+    The 'compile' command compiles all the templates to Python modules in the
+    directory TARGET, or the zip archive TARGET if it ends with '.zip'. TARGET
+    defaults to the 'precompiled' option of the Jinja2 configuration, which
+    makes the application load the templates from there without parsing their
+    source.
+
+    options:
+      -h, --help                                 show this help message and exit
+      -e ENVIRONMENT, --environment ENVIRONMENT  apply the given config environment
+      -C ENV_VAR_NAME, --env-var ENV_VAR_NAME    add the given config from environment variable name
+                                                 [default: BLUEBERRYPY_CONFIG]
+      -x EXTENSIONS, --extensions EXTENSIONS     only the templates with these comma separated
+                                                 file extensions
+
+    """
+
+    config = BlueberryPyConfiguration(config_dir=kwargs.get('config_dir'),
+                                      env_var_name=kwargs.get('env_var'),
+                                      environment=kwargs.get('environment'))
+
+    if not config.use_jinja2:
+        raise BlueberryPyNotConfiguredError("Jinja2 configuration not found.")
+
+    # The templates are compiled from their source, not loaded from the
+    # modules they were compiled to before.
+    jinja2_config = config.jinja2_config
+    precompiled = jinja2_config.pop("precompiled", None)
+
+    extensions = kwargs.get("extensions")
+    if extensions:
+        extensions = [extension.strip().lstrip(".") for extension in extensions.split(",")]
+
+    if kwargs.get("compile"):
+        target = kwargs.get("TARGET") or precompiled
+        if not target:
+            raise BlueberryPyNotConfiguredError("No target given, and no 'precompiled' option "
+                                                "found in the Jinja2 configuration.")
+    elif config.use_redis:
+        from blueberrypy.session import RedisSession
+        RedisSession.setup(**config.redis_session_config)
+
+    if config.webassets_env:
+        jinja2_env = configure_jinja2(assets_env=config.webassets_env, **jinja2_config)
+    else:
+        jinja2_env = configure_jinja2(**jinja2_config)
+
+    if kwargs.get("compile"):
+        compiled, failed = compile_templates(target, jinja2_env, extensions)
+        done = "compiled to %s" % target
+    else:
+        compiled, failed = warm_bytecode_cache(jinja2_env, extensions)
+        done = "compiled into the bytecode cache"
+
+    for name, e in sorted(failed.items()):
+        logger.error("Could not compile %s: %s" % (name, e))
+    logger.info("%d template(s) %s, %d failed." % (len(compiled), done, len(failed)))
+    if failed:
+        sys.exit(1)
+
+
 def serve(**kwargs):
     """
     Spawn a new running Cherrypy process
@@ -275,11 +348,26 @@ def serve(**kwargs):
 
     if config.use_sqlalchemy:
         from blueberrypy.plugins import SQLAlchemyPlugin
+
+        def reload_sqlalchemy_config():
+            return BlueberryPyConfiguration(config_dir=kwargs.get('config_dir'),
+                                            env_var_name=kwargs.get('env_var'),
+                                            environment=cpenviron).sqlalchemy_config
+
         cpengine.sqlalchemy = SQLAlchemyPlugin(cpengine,
-                                               config=config.sqlalchemy_config)
+                                               config=config.sqlalchemy_config,
+                                               reload_config=reload_sqlalchemy_config)
         from blueberrypy.tools import SQLAlchemySessionTool
         cherrypy.tools.orm_session = SQLAlchemySessionTool()
 
+    if config.json_config.get("backend"):
+        from blueberrypy import jsonlib
+        jsonlib.set_backend(config.json_config["backend"])
+
+    if config.json_config.get("tools"):
+        from blueberrypy import jsontools
+        jsontools.setup_tools()
+
     if config.use_jinja2:
         if config.webassets_env:
             configure_jinja2(assets_env=config.webassets_env,
@@ -462,11 +550,12 @@ def main():
 
 
     The list of possible commands are:
-        help     print this help or a command's if an argument is given
-        create   create a project skeleton
-        console  blueberrypy REPL for experimentations
-        bundle   bundles up web assets (type 'blueberrypy help bundle' for details)
-        serve    spawn a new CherryPy server process
+        help       print this help or a command's if an argument is given
+        create     create a project skeleton
+        console    blueberrypy REPL for experimentations
+        bundle     bundles up web assets (type 'blueberrypy help bundle' for details)
+        templates  manages Jinja2 templates (type 'blueberrypy help templates' for details)
+        serve      spawn a new CherryPy server process
 
 
     See 'blueberrypy help COMMAND' for more information on a specific command.
@@ -490,10 +579,13 @@ def main():
             doc, callback = console.__doc__, console
         elif command == "bundle":
             doc, callback = bundle.__doc__, bundle
+        elif command == "templates":
+            doc, callback = templates.__doc__, templates
         elif command == "serve":
             doc, callback = serve.__doc__, serve
         elif command == "help":
-            if command_args and command_args[0] in ["create", "console", "bundle", "serve"]:
+            if command_args and command_args[0] in ["create", "console", "bundle", "templates",
+                                                    "serve"]:
                 callback = globals()[command_args[0]]
                 doc = callback.__doc__
             else:
@@ -16,15 +16,7 @@ try:
 except ImportError:
     from yaml import Loader
 
-json = None
-for pkg in ['ujson', 'yajl', 'simplejson', 'cjson', 'json']:
-    try:
-        json = importlib.import_module(pkg)
-    except:
-        pass
-    else:
-        break
-
+from blueberrypy import jsonlib
 from blueberrypy.email import Mailer
 from blueberrypy.exc import (BlueberryPyNotConfiguredError,
                              BlueberryPyConfigurationError)
@@ -227,6 +219,23 @@ class BlueberryPyConfiguration(object):
                         return True
         return False
 
+    @property
+    def redis_session_config(self):
+        """The parameters `blueberrypy.session.RedisSession.setup` is given
+        for the first path using Redis sessions, or None."""
+        if self.controllers_config:
+            from cherrypy.lib import sessions
+            tool_args = set(inspect.getargspec(sessions.init).args) | set(["on", "priority"])
+            for _, controller_config in self.controllers_config.viewitems():
+                controller_config = controller_config.copy()
+                controller_config.pop("controller")
+                for path_config in controller_config.viewvalues():
+                    if path_config.get("tools.sessions.storage_type") == "redis":
+                        return dict((k[len("tools.sessions."):], v)
+                                    for k, v in path_config.viewitems()
+                                    if k.startswith("tools.sessions.") and
+                                    k[len("tools.sessions."):] not in tool_args)
+
     @property
     def use_sqlalchemy(self):
         return self.app_config.get("global", {}).get("engine.sqlalchemy.on", False)
@@ -280,6 +289,13 @@ class BlueberryPyConfiguration(object):
     def email_config(self):
         return self.app_config.get("email")
 
+    @property
+    def json_config(self):
+        """The `json` section: the `backend` of `blueberrypy.jsonlib` to
+        select, if not the stdlib-compatible one, and whether to replace the
+        CherryPy `json_in` and `json_out` tools (`tools`)."""
+        return self.app_config.get("json", {})
+
     def setup_backlash_environment(self):
         """
         Returns a new copy of this configuration object configured to run under
@@ -391,8 +407,8 @@ class BlueberryPyConfiguration(object):
     def _load_env_var(cls, env_var_name):
         env_conf = {}
         try:
-            env_conf = json.loads(os.getenv(env_var_name),
-                                  object_hook=cls._callable_json_loader)
+            env_conf = jsonlib.loads(os.getenv(env_var_name),
+                                     object_hook=cls._callable_json_loader)
         except ValueError:
             # Don't use simplejson.JSONDecodeError, since it only exists in
             # simplejson implementation and is a subclass of ValueError
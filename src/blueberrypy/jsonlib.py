@@ -0,0 +1,266 @@
+"""A registry of JSON encoder/decoder backends.
+
+The backends are registered in the order `orjson`, `ujson`, `yajl`,
+`simplejson`, `cjson` and finally `json` from the standard library. By default
+the first available stdlib-compatible backend (`simplejson` or `json`) is
+used, so the output is the same as with `json` itself. The faster backends
+are opt-in: `set_backend("fastest")` selects the first available backend,
+and `set_backend(name)` a given one.
+
+Most of the fast backends only understand a subset of the keyword arguments
+`json.dumps()` and `json.loads()` accept. When a call is made with arguments
+the selected backend doesn't support, or the selected backend fails to encode
+a value (such as a `Decimal` or a dict with non-string keys), the call is
+transparently handed over to the fastest stdlib-compatible backend, so the
+results are the same as they would be with `json` itself, save for
+insignificant whitespace.
+
+Example::
+
+    >>> from blueberrypy import jsonlib
+    >>> jsonlib.loads(jsonlib.dumps({"a": [1, 2]})) #doctest: +SKIP
+    {u'a': [1, 2]}
+    >>> "".join(jsonlib.dump_chunks(iter([1, 2]))) #doctest: +SKIP
+    '[1, 2]'
+"""
+
+from __future__ import absolute_import
+
+import importlib
+import logging
+
+
+__all__ = ["JSONBackend", "register_backend", "get_backend", "set_backend",
+           "dumps", "dumpb", "loads", "dump_chunks"]
+
+
+logger = logging.getLogger(__name__)
+
+
+class JSONBackend(object):
+    """A JSON backend adapter.
+
+    `dumps_kwargs` and `loads_kwargs` are the keyword arguments `dumps` and
+    `loads` accept, or None if they accept all the keyword arguments of the
+    standard library `json` module. If `binary` is True, `dumps` returns
+    UTF-8 encoded bytes instead of a string.
+    """
+
+    def __init__(self, name, dumps, loads, dumps_kwargs=None, loads_kwargs=None,
+                 binary=False, item_separator=", "):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.dumps_kwargs = frozenset(dumps_kwargs) if dumps_kwargs is not None else None
+        self.loads_kwargs = frozenset(loads_kwargs) if loads_kwargs is not None else None
+        self.binary = binary
+        self.item_separator = item_separator
+
+    @property
+    def compatible(self):
+        return self.dumps_kwargs is None and self.loads_kwargs is None
+
+    def can_dump(self, kwargs):
+        return self.dumps_kwargs is None or self.dumps_kwargs.issuperset(kwargs)
+
+    def can_load(self, kwargs):
+        return self.loads_kwargs is None or self.loads_kwargs.issuperset(kwargs)
+
+    def __repr__(self):
+        return "JSONBackend(%r)" % self.name
+
+
+def _load_orjson():
+    orjson = importlib.import_module("orjson")
+
+    def dumps(obj, sort_keys=False, default=None):
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+    return JSONBackend("orjson", dumps, orjson.loads,
+                       dumps_kwargs=("sort_keys", "default"), loads_kwargs=(),
+                       binary=True, item_separator=",")
+
+
+def _load_ujson():
+    ujson = importlib.import_module("ujson")
+    # ujson<2 rounds floats to 10 decimal places by default
+    if int(getattr(ujson, "__version__", "0").split(".")[0]) < 2:
+        raise ImportError("ujson>=2 is required")
+
+    def dumps(obj, **kwargs):
+        return ujson.dumps(obj, escape_forward_slashes=False, **kwargs)
+
+    return JSONBackend("ujson", dumps, ujson.loads,
+                       dumps_kwargs=("sort_keys", "ensure_ascii", "indent"), loads_kwargs=(),
+                       item_separator=",")
+
+
+def _load_yajl():
+    yajl = importlib.import_module("yajl")
+    return JSONBackend("yajl", yajl.dumps, yajl.loads, dumps_kwargs=(), loads_kwargs=(),
+                       item_separator=",")
+
+
+def _load_cjson():
+    cjson = importlib.import_module("cjson")
+    return JSONBackend("cjson", cjson.encode, cjson.decode, dumps_kwargs=(), loads_kwargs=())
+
+
+def _load_simplejson():
+    simplejson = importlib.import_module("simplejson")
+    return JSONBackend("simplejson", simplejson.dumps, simplejson.loads)
+
+
+def _load_json():
+    json = importlib.import_module("json")
+    return JSONBackend("json", json.dumps, json.loads)
+
+
+_loaders = [("orjson", _load_orjson),
+            ("ujson", _load_ujson),
+            ("yajl", _load_yajl),
+            ("simplejson", _load_simplejson),
+            ("cjson", _load_cjson),
+            ("json", _load_json)]
+
+_backend = None
+_compatible_backend = None
+
+
+def register_backend(name, loader, first=False):
+    """Register a JSON backend.
+
+    `loader` is a callable that takes no arguments and returns a
+    `JSONBackend`, or raises ImportError if the backend is not available. If
+    `first` is True, the backend is preferred over all the already registered
+    backends, otherwise it's tried last, just before the standard library
+    `json` module.
+    """
+    global _backend, _compatible_backend
+
+    if first:
+        _loaders.insert(0, (name, loader))
+    else:
+        _loaders.insert(len(_loaders) - 1, (name, loader))
+
+    _backend = _compatible_backend = None
+
+
+def _select(compatible=False):
+    for name, loader in _loaders:
+        try:
+            backend = loader()
+        except ImportError:
+            continue
+        if compatible and not backend.compatible:
+            continue
+        return backend
+
+
+def get_backend():
+    """Return the selected JSON backend."""
+    global _backend
+    if _backend is None:
+        _backend = _select(compatible=True)
+        logger.debug("Using %r as JSON backend.", _backend)
+    return _backend
+
+
+def set_backend(name):
+    """Select the registered JSON backend `name`, or the fastest available
+    one if `name` is "fastest", instead of the stdlib-compatible one."""
+    global _backend, _compatible_backend
+    if name == "fastest":
+        _backend = _select()
+        _compatible_backend = None
+        return _backend
+    for backend_name, loader in _loaders:
+        if backend_name == name:
+            _backend = loader()
+            _compatible_backend = None
+            return _backend
+    raise ValueError("Unknown JSON backend %r." % name)
+
+
+def _get_compatible_backend():
+    global _compatible_backend
+    if _compatible_backend is None:
+        backend = get_backend()
+        _compatible_backend = backend if backend.compatible else _select(compatible=True)
+    return _compatible_backend
+
+
+def _dumps(obj, kwargs):
+    backend = get_backend()
+    if not backend.compatible and backend.can_dump(kwargs):
+        try:
+            return backend, backend.dumps(obj, **kwargs)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    backend = _get_compatible_backend()
+    return backend, backend.dumps(obj, **kwargs)
+
+
+def dumps(obj, **kwargs):
+    """Serialize `obj` to a JSON formatted string."""
+    backend, result = _dumps(obj, kwargs)
+    if backend.binary:
+        return result.decode("utf-8")
+    return result
+
+
+def dumpb(obj, **kwargs):
+    """Serialize `obj` to UTF-8 encoded JSON bytes."""
+    backend, result = _dumps(obj, kwargs)
+    if isinstance(result, bytes):
+        return result
+    return result.encode("utf-8")
+
+
+def loads(s, **kwargs):
+    """Deserialize the JSON document `s` to a Python object."""
+    backend = get_backend()
+    if not backend.can_load(kwargs):
+        backend = _get_compatible_backend()
+    return backend.loads(s, **kwargs)
+
+
+DUMP_CHUNKS_BUFFER_SIZE = 8192
+
+
+def _is_iterator(obj):
+    try:
+        return iter(obj) is obj
+    except TypeError:
+        return False
+
+
+def dump_chunks(obj, **kwargs):
+    """Serialize `obj` to JSON, yielding the result in chunks.
+
+    If `obj` is an iterator, such as a generator, it is serialized as a JSON
+    array one element at a time, and the encoded elements are yielded in
+    chunks of roughly `DUMP_CHUNKS_BUFFER_SIZE` characters, so the entire
+    document never has to be held in memory. Anything else is yielded in one
+    chunk.
+    """
+    if not _is_iterator(obj):
+        yield dumps(obj, **kwargs)
+        return
+
+    separators = kwargs.get("separators")
+    item_separator = separators[0] if separators else get_backend().item_separator
+
+    buf, buf_len = ["["], 1
+    for i, v in enumerate(obj):
+        chunk = dumps(v, **kwargs)
+        if i:
+            buf.append(item_separator)
+        buf.append(chunk)
+        buf_len += len(chunk)
+        if buf_len >= DUMP_CHUNKS_BUFFER_SIZE:
+            yield "".join(buf)
+            buf, buf_len = [], 0
+    buf.append("]")
+    yield "".join(buf)
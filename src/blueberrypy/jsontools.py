@@ -0,0 +1,63 @@
+"""Drop-in replacements for CherryPy's `json_in` and `json_out` tools.
+
+These behave exactly like the tools in `cherrypy.lib.jsontools`, except that
+the request and response bodies are decoded and encoded with the JSON backend
+selected by `blueberrypy.jsonlib`.
+
+Example::
+
+    cherrypy.tools.json_in = cherrypy.Tool("before_request_body", json_in, priority=30)
+    cherrypy.tools.json_out = cherrypy.Tool("before_handler", json_out, priority=30)
+"""
+
+import cherrypy
+from cherrypy.lib import jsontools as cpjsontools
+
+from blueberrypy import jsonlib
+
+
+__all__ = ["json_processor", "json_in", "json_handler", "json_out", "setup_tools"]
+
+
+def json_processor(entity):
+    """Read application/json data into request.json."""
+    if not entity.headers.get(u"Content-Length", u""):
+        raise cherrypy.HTTPError(411)
+
+    body = entity.fp.read()
+    with cherrypy.HTTPError.handle(ValueError, 400, "Invalid JSON document"):
+        cherrypy.serving.request.json = jsonlib.loads(body.decode("utf-8"))
+
+
+def json_in(content_type=[u"application/json", u"text/javascript"], force=True, debug=False,
+            processor=json_processor):
+    """Add a processor to parse JSON request entities into request.json.
+
+    See `cherrypy.lib.jsontools.json_in`.
+    """
+    cpjsontools.json_in(content_type=content_type, force=force, debug=debug,
+                        processor=processor)
+
+
+def json_handler(*args, **kwargs):
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    return jsonlib.dumpb(value)
+
+
+def json_out(content_type="application/json", debug=False, handler=json_handler):
+    """Wrap request.handler to serialize its output to JSON. Sets Content-Type.
+
+    See `cherrypy.lib.jsontools.json_out`.
+    """
+    cpjsontools.json_out(content_type=content_type, debug=debug, handler=handler)
+
+
+def setup_tools(toolbox=None):
+    """Replace `json_in` and `json_out` in `toolbox` with the tools above.
+
+    `toolbox` defaults to `cherrypy.tools`.
+    """
+    if toolbox is None:
+        toolbox = cherrypy.tools
+    toolbox.json_in = cherrypy.Tool("before_request_body", json_in, priority=30)
+    toolbox.json_out = cherrypy.Tool("before_handler", json_out, priority=30)
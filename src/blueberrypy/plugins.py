@@ -1,15 +1,27 @@
+import bisect
+import contextlib
+import importlib
+import itertools
 import logging
+import os
 import textwrap
+import threading
+import time
 
 try:
     from logging.config import dictConfig
 except ImportError:
     from logutils.dictconfig import dictConfig
 
-from cherrypy.process.plugins import SimplePlugin
+import cherrypy
+from cherrypy.process.plugins import DropPrivileges, SimplePlugin
 
+from blueberrypy import jsonlib
+from blueberrypy.exc import BlueberryPyConfigurationError
 
-__all__ = ['LoggingPlugin', 'SQLAlchemyPlugin']
+
+__all__ = ['LoggingPlugin', 'SQLAlchemyPlugin', 'ReplicaSet', 'Histogram', 'PoolMetrics',
+           'JSONStatus', 'PoolStatus', 'SQLAlchemyPoolStatus']
 
 
 class LoggingPlugin(SimplePlugin):
@@ -37,6 +49,298 @@ class LoggingPlugin(SimplePlugin):
         logging.shutdown()
 
 
+@contextlib.contextmanager
+def _dropped_privileges(bus):
+    """Switch the effective user and group to the ones the `DropPrivileges`
+    plugin subscribed to `bus`, if any, switches to, while in the block."""
+    drop_privileges = None
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        for listener in bus.listeners.get("start", ()):
+            if isinstance(getattr(listener, "__self__", None), DropPrivileges):
+                drop_privileges = listener.__self__
+                break
+    if drop_privileges is None:
+        yield
+        return
+
+    gid = os.getegid()
+    if drop_privileges.gid is not None:
+        os.setegid(drop_privileges.gid)
+    if drop_privileges.uid is not None:
+        os.seteuid(drop_privileges.uid)
+    try:
+        yield
+    finally:
+        os.seteuid(0)
+        os.setegid(gid)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Overwritten by the next statement if this one fails.
+    conn.info["replica_query_start_time"] = time.time()
+
+
+class ReplicaSet(object):
+    """The read replicas of an engine.
+
+    `selection` is either "round_robin", to use each replica in turn, or
+    "least_latency", to use the replica with the lowest moving average of
+    statement execution times. Every `probe_interval`th choice still goes to
+    the next replica in turn, so the latencies of the others are measured
+    again, and a replica that was slow for a while is used again once it
+    isn't anymore.
+    """
+
+    selections = ("round_robin", "least_latency")
+
+    probe_interval = 20
+
+    def __init__(self, engines, selection="round_robin"):
+        if selection not in self.selections:
+            raise ValueError("Unknown replica selection %r." % selection)
+
+        self.engines = engines
+        self.selection = selection
+        self.latencies = dict.fromkeys(engines, 0.0)
+        self._cycle = itertools.cycle(engines)
+        self._choices = itertools.count(1)
+        self._lock = threading.Lock()
+
+        if selection == "least_latency":
+            from sqlalchemy import event
+            for engine in engines:
+                event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+                event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop("replica_query_start_time", None)
+        if start is None:
+            return
+        elapsed = time.time() - start
+        engine = conn.engine
+        with self._lock:
+            self.latencies[engine] = self.latencies[engine] * 0.8 + elapsed * 0.2
+
+    def choose(self):
+        """Return the replica to use next."""
+        with self._lock:
+            if (self.selection == "least_latency" and
+                    next(self._choices) % self.probe_interval):
+                return min(self.engines, key=self.latencies.__getitem__)
+            return next(self._cycle)
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+class Histogram(object):
+    """Counts values, such as durations, in buckets bounded by `buckets`,
+    and keeps their count, total and maximum.
+
+    It isn't thread-safe, the metrics it's part of have to lock it.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def snapshot(self):
+        """Return the count of each bucket as a list of dicts, the last one
+        counting the values above all the bounds."""
+        return [{"le": le, "count": count}
+                for le, count in zip(self.buckets + (None,), self.counts)]
+
+
+class PoolMetrics(object):
+    """Live metrics of an engine's connection pool.
+
+    Counts checkouts, new connections, failed connection attempts and
+    invalidated connections, and keeps a histogram of how long checkouts
+    waited for a connection. The buckets of the histogram are bounded by
+    `wait_buckets`, in seconds.
+    """
+
+    wait_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, name, engine):
+        from sqlalchemy import event
+
+        self.name = name
+        self.engine = engine
+        self._lock = threading.Lock()
+
+        self.checkouts = 0
+        self.checked_out = 0
+        self.connects = 0
+        self.connect_errors = 0
+        self.consecutive_connect_errors = 0
+        self.last_connect_error = None
+        self.invalidations = 0
+        self.wait = Histogram(self.wait_buckets)
+
+        # Pool events registered on an engine also apply to the pools it
+        # recreates when it's disposed.
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        self._instrument_pool(engine.pool)
+
+    def _instrument_pool(self, pool):
+        # There's no pool event fired before a checkout, so time it by
+        # overriding the checkout methods in a subclass of the pool's class.
+        # A disposed engine recreates its pool with the same class.
+        pool_class = type(pool)
+        metrics = self
+
+        def timed(checkout):
+            def wrapper(self):
+                start = time.time()
+                try:
+                    connection = checkout(self)
+                except Exception as e:
+                    metrics._record_wait(time.time() - start, e)
+                    raise
+                metrics._record_wait(time.time() - start)
+                return connection
+            return wrapper
+
+        class InstrumentedPool(pool_class):
+            connect = timed(pool_class.connect)
+            unique_connection = timed(pool_class.unique_connection)
+
+        InstrumentedPool.__name__ = pool_class.__name__
+        pool.__class__ = InstrumentedPool
+
+    def _record_wait(self, seconds, error=None):
+        with self._lock:
+            if error is not None:
+                self.connect_errors += 1
+                self.consecutive_connect_errors += 1
+                self.last_connect_error = str(error)
+                return
+            self.consecutive_connect_errors = 0
+            self.wait.add(seconds)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checked_out -= 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    @property
+    def healthy(self):
+        """False if the last attempt to connect to the database failed."""
+        return self.consecutive_connect_errors == 0
+
+    def snapshot(self):
+        """Return the current metrics as a dict."""
+        pool = self.engine.pool
+        with self._lock:
+            snapshot = {"name": self.name,
+                        "url": repr(self.engine.url),
+                        "healthy": self.healthy,
+                        "checkouts": self.checkouts,
+                        "checked_out": self.checked_out,
+                        "connects": self.connects,
+                        "connect_errors": self.connect_errors,
+                        "last_connect_error": self.last_connect_error,
+                        "invalidations": self.invalidations,
+                        "wait_total": self.wait.total,
+                        "wait_max": self.wait.max,
+                        "wait_histogram": self.wait.snapshot()}
+        # Only QueuePool has a fixed size and overflow.
+        if hasattr(pool, "overflow"):
+            snapshot.update(pool_size=pool.size(), overflow=pool.overflow(),
+                            checked_out=pool.checkedout())
+        return snapshot
+
+
+class JSONStatus(object):
+    """A controller serving as JSON the metrics returned by `stats`, a
+    callable taking no arguments.
+
+    The response status is 503 if `healthy`, if given, returns False when
+    called with the metrics.
+
+    Example::
+
+        cherrypy.tree.mount(JSONStatus(get_queue_stats), "/status/queue")
+    """
+
+    def __init__(self, stats, healthy=None):
+        self.stats = stats
+        self.healthy = healthy
+
+    @cherrypy.expose
+    def index(self):
+        stats = self.stats()
+        if self.healthy is not None and not self.healthy(stats):
+            cherrypy.response.status = 503
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        return jsonlib.dumpb(stats)
+
+
+class PoolStatus(JSONStatus):
+    """A controller serving as JSON the connection pool metrics returned by
+    everyone subscribed to the `channel` bus channel, each a list of dicts.
+
+    The response status is 503 if any of the pools isn't `healthy`.
+
+    Example::
+
+        cherrypy.tree.mount(PoolStatus("redis.pool_stats"), "/status/redis")
+    """
+
+    def __init__(self, channel):
+        JSONStatus.__init__(self, self._publish, self._all_healthy)
+        self.channel = channel
+
+    def _publish(self):
+        stats = []
+        for subscriber_stats in cherrypy.engine.publish(self.channel):
+            stats.extend(subscriber_stats)
+        return stats
+
+    @staticmethod
+    def _all_healthy(stats):
+        return all(pool_stats.get("healthy", True) for pool_stats in stats)
+
+
+class SQLAlchemyPoolStatus(PoolStatus):
+    """A `PoolStatus` serving the metrics of all the SQLAlchemy connection
+    pools, see `PoolMetrics`.
+
+    Example::
+
+        cherrypy.tree.mount(SQLAlchemyPoolStatus(), "/status/db")
+    """
+
+    def __init__(self, channel="sqlalchemy.pool_stats"):
+        PoolStatus.__init__(self, channel)
+
+
 class SQLAlchemyPlugin(SimplePlugin):
     """Sets up process-wide SQLAlchemy engines.
 
@@ -44,33 +348,90 @@ class SQLAlchemyPlugin(SimplePlugin):
     Engine bindings are in the exact format as the `binds` keyword in
     `Session.configure()`.
 
-    In the future in case we ever get to horizontal sharding, this plugin will
-    need to be updated.
+    For horizontal sharding, the engines of all the shards and the functions
+    choosing among them are set up to be passed to a
+    `sqlalchemy.ext.horizontal_shard.ShardedSession`.
+
+    The connection pool of every engine is monitored by a `PoolMetrics`, and
+    the metrics of all of them are returned to anyone publishing to the
+    `stats_channel` bus channel, such as `SQLAlchemyPoolStatus`.
+
+    On a graceful restart, the engines are swapped for new ones configured
+    from the config returned by `reload_config`, if given, see `graceful`.
     """
 
-    def __init__(self, bus, config, prefix="sqlalchemy_engine"):
+    def __init__(self, bus, config, prefix="sqlalchemy_engine",
+                 stats_channel="sqlalchemy.pool_stats", reload_config=None, drain_timeout=60):
         SimplePlugin.__init__(self, bus)
         self.config = config
         self.prefix = prefix
+        self.stats_channel = stats_channel
+        self.reload_config = reload_config
+        self.drain_timeout = drain_timeout
+        self.pool_metrics = []
+
+    def subscribe(self):
+        SimplePlugin.subscribe(self)
+        self.bus.subscribe(self.stats_channel, self.pool_stats)
+
+    def unsubscribe(self):
+        SimplePlugin.unsubscribe(self)
+        self.bus.unsubscribe(self.stats_channel, self.pool_stats)
+
+    def pool_stats(self):
+        """Return a list of the metrics of all the engines' connection pools."""
+        return [metrics.snapshot() for metrics in self.pool_metrics]
 
     def start(self):
         self._configure_engines()
         self.bus.log("SQLAlchemy Plugin started")
-    start.priority = 83
+    # Before the HTTP server starts accepting requests, so the engines are
+    # set up and warmed up when the first request comes in.
+    start.priority = 74
 
     def graceful(self):
-        if hasattr(self, "engine_bindings"):
-            engine_bindings = self.engine_bindings
-            for engine in engine_bindings.viewvalues():
-                self.bus.log("Disposing SQLAlchemy engine %s ..." % engine.url)
-                engine.dispose()
-        elif hasattr(self, "engine"):
-            engine = self.engine
-            self.bus.log("Disposing SQLAlchemy engine %s ..." % engine.url)
-            engine.dispose()
-    stop = graceful
+        """Replace the engines with new ones configured from the current, or
+        reloaded, config.
+
+        The new engines are created, and warmed up if asked, before they
+        replace the old ones, so requests never wait for an engine. The pools
+        of the old engines are disposed in the background as soon as the
+        in-flight requests return their connections, or after
+        `drain_timeout` seconds.
+        """
+        old_metrics = list(self.pool_metrics)
+        try:
+            config = self.reload_config() if self.reload_config is not None else self.config
+            self._configure_engines(config)
+        except Exception:
+            self.bus.log("Reconfiguring SQLAlchemy engines failed, keeping the current ones",
+                         level=logging.ERROR, traceback=True)
+            return
+
+        drain = threading.Thread(target=self._drain, args=(old_metrics,),
+                                 name="SQLAlchemyPluginDrain")
+        drain.daemon = True
+        drain.start()
+
+    def stop(self):
+        for metrics in self.pool_metrics:
+            self.bus.log("Disposing SQLAlchemy engine %s ..." % metrics.engine.url)
+            metrics.engine.dispose()
+
+    def _drain(self, pool_metrics):
+        deadline = time.time() + self.drain_timeout
+        for metrics in pool_metrics:
+            while metrics.checked_out > 0 and time.time() < deadline:
+                time.sleep(0.1)
+            if metrics.checked_out > 0:
+                self.bus.log("Disposing old SQLAlchemy engine %s with %d connection(s) still "
+                             "checked out" % (metrics.engine.url, metrics.checked_out),
+                             level=logging.WARNING)
+            else:
+                self.bus.log("Disposing old SQLAlchemy engine %s ..." % metrics.engine.url)
+            metrics.engine.dispose()
 
-    def _configure_engines(self):
+    def _configure_engines(self, config=None):
         """Sets up engine bindings based on the given config.
 
         Given a configuration dictionary, and optionally a key `prefix`, this
@@ -86,6 +447,12 @@ class SQLAlchemyPlugin(SimplePlugin):
         that section's values are use to configure only one SQLAlchemy engine
         attached to `cherrypy.engine.sqlalchemy.engine`.
 
+        A section may also list the URLs of read replicas of its database in
+        `replicas`, and how to choose among them in `replica_selection`, see
+        `ReplicaSet`. The replica engines are configured with the same
+        parameters as the section's engine, and their `ReplicaSet` is to be
+        found in `cherrypy.engine.sqlalchemy.replicas`, keyed by that engine.
+
         Example::
 
             # The model to be imported starts after the _ following the prefix
@@ -96,7 +463,38 @@ class SQLAlchemyPlugin(SimplePlugin):
             # If this section exists, only 1 engine will be configured
             [sqlalchemy_engine]
             url = ...
+            replicas = ... ...
+            replica_selection = least_latency
+
+        If the section named exactly the same as the `prefix` has a `shards`
+        option instead, an engine is set up for each shard it lists instead,
+        and they are attached to `cherrypy.engine.sqlalchemy.shards`, keyed by
+        their shard ids. Each shard is either given by its URL, or by a dict of
+        the parameters that differ from the section's. The `shard_chooser`,
+        `id_chooser` and `query_chooser` options are the fully qualified names
+        of the functions `ShardedSession` takes, and are imported into
+        `cherrypy.engine.sqlalchemy.shard_choosers`.
 
+        Example::
+
+            [sqlalchemy_engine]
+            pool_recycle = ...
+            shards = {"north": "postgresql://north/...",
+                      "south": {"url": "postgresql://south/...", "pool_size": 20}}
+            shard_chooser = myproject.sharding.shard_chooser
+            id_chooser = myproject.sharding.id_chooser
+            query_chooser = myproject.sharding.query_chooser
+
+        Any section may also set `warmup` to the number of connections to
+        open in each of its engines' pools up front, and `warmup_query` to a
+        statement, such as ``SELECT 1``, to run on each of them, so the first
+        requests don't have to wait for the connections to be established.
+        The engines are warmed up before they replace the current ones, see
+        `_warm_up_engines`.
+
+        `config` defaults to the plugin's. It only replaces it once all of its
+        engines are set up. If any of them fails, the ones already set up are
+        disposed, and the current engines and config are left untouched.
 
         :py:func: sqlalchemy.engine_from_config
         """
@@ -112,26 +510,177 @@ class SQLAlchemyPlugin(SimplePlugin):
             $ pip install sqlalchemy
             """))
         else:
-            if self.prefix in self.config:
-                section = self.config[self.prefix]
-                self.engine = engine_from_config(section, '')
-                self.bus.log("SQLAlchemy engine configured")
-            else:
-                engine_bindings = {}
-
-                for section_name, section in self.config.viewitems():
-                    if section_name.startswith(self.prefix):
-                        model_fqn = section_name[len(self.prefix) + 1:]
-                        model_fqn_parts = model_fqn.rsplit('.', 1)
-                        try:
-                            model_mod = __import__(model_fqn_parts[0], globals(), locals(),
-                                                   [model_fqn_parts[1]])
-                        except ImportError as e:
-                            self.bus.log(e, level=40)
-                        else:
-                            model = getattr(model_mod, model_fqn_parts[1])
-                            engine_bindings[model] = engine_from_config(section, '')
-
-                self.engine_bindings = engine_bindings
-
-                self.bus.log("SQLAlchemy engines configured")
+            if config is None:
+                config = self.config
+            replicas = {}
+            pool_metrics = []
+            warmups = []
+            engines = {}
+
+            try:
+                self._create_engines(engine_from_config, config, replicas, pool_metrics,
+                                     warmups, engines)
+            except Exception:
+                for metrics in pool_metrics:
+                    metrics.engine.dispose()
+                raise
+
+            self._warm_up_engines(warmups)
+            self.config = config
+            self._swap_engines(replicas, pool_metrics, engines)
+
+    def _create_engines(self, engine_from_config, config, replicas, pool_metrics, warmups,
+                        engines):
+        if self.prefix in config and "shards" in config[self.prefix]:
+            engines["shards"], engines["shard_choosers"] = self._configure_shards(
+                engine_from_config, self.prefix, config[self.prefix], replicas,
+                pool_metrics, warmups)
+        elif self.prefix in config:
+            section = config[self.prefix]
+            engines["engine"] = self._create_engine(engine_from_config, section,
+                                                    self.prefix, replicas, pool_metrics,
+                                                    warmups)
+            self.bus.log("SQLAlchemy engine configured")
+        else:
+            engine_bindings = {}
+
+            for section_name, section in config.items():
+                if section_name.startswith(self.prefix):
+                    model_fqn = section_name[len(self.prefix) + 1:]
+                    model_fqn_parts = model_fqn.rsplit('.', 1)
+                    try:
+                        model_mod = __import__(model_fqn_parts[0], globals(), locals(),
+                                               [model_fqn_parts[1]])
+                    except ImportError as e:
+                        self.bus.log(e, level=40)
+                    else:
+                        model = getattr(model_mod, model_fqn_parts[1])
+                        engine_bindings[model] = self._create_engine(
+                            engine_from_config, section, model_fqn, replicas, pool_metrics,
+                            warmups)
+
+            engines["engine_bindings"] = engine_bindings
+
+            self.bus.log("SQLAlchemy engines configured")
+
+    def _swap_engines(self, replicas, pool_metrics, engines):
+        # The replicas and shard choosers go first, so a request never finds
+        # an engine without them. Whatever the new config no longer sets up
+        # is only removed once the new engines are in place.
+        self.replicas = replicas
+        self.pool_metrics = pool_metrics
+        for name in ("shard_choosers", "shards", "engine_bindings", "engine"):
+            if name in engines:
+                setattr(self, name, engines[name])
+        for name in ("shard_choosers", "shards", "engine_bindings", "engine"):
+            if name not in engines and hasattr(self, name):
+                delattr(self, name)
+
+    def _create_engine(self, engine_from_config, section, name, replicas, pool_metrics,
+                       warmups):
+        section = dict(section)
+        replica_urls = section.pop("replicas", None)
+        replica_selection = section.pop("replica_selection", "round_robin")
+        warmup = int(section.pop("warmup", 0))
+        warmup_query = section.pop("warmup_query", None)
+
+        engine = engine_from_config(section, '')
+        pool_metrics.append(PoolMetrics(name, engine))
+        warmups.append((engine, warmup, warmup_query))
+
+        if replica_urls:
+            if not isinstance(replica_urls, (list, tuple)):
+                replica_urls = replica_urls.replace(",", " ").split()
+            replica_engines = []
+            for i, url in enumerate(replica_urls):
+                replica = engine_from_config(dict(section, url=url), '')
+                pool_metrics.append(PoolMetrics("%s replica %d" % (name, i), replica))
+                warmups.append((replica, warmup, warmup_query))
+                replica_engines.append(replica)
+            replicas[engine] = ReplicaSet(replica_engines, replica_selection)
+            self.bus.log("SQLAlchemy replica engines configured")
+
+        return engine
+
+    def _warm_up_engines(self, warmups):
+        """Warm up the engines of `warmups`, a list of `(engine, size, query)`
+        tuples, see `_warm_up`.
+
+        The engines are warmed up before the HTTP server starts, but the
+        `DropPrivileges` plugin only drops them after, so the connections are
+        opened as the user and group it switches to meanwhile.
+        """
+        with _dropped_privileges(self.bus):
+            for engine, size, query in warmups:
+                self._warm_up(engine, size, query)
+
+    def _warm_up(self, engine, size, query=None):
+        """Open `size` connections in the pool of `engine`, running `query` on
+        each of them if given.
+
+        The connections are all checked out before any of them is returned to
+        the pool, so the pool has to establish as many of them. Failures are
+        only logged, the pool will try again when the connections are needed.
+
+        `size` is capped to the size of the pool, since the connections
+        opened beyond it would be closed as soon as they're returned.
+        """
+        # Only QueuePool has a fixed size and overflow.
+        if hasattr(engine.pool, "overflow"):
+            size = min(size, engine.pool.size())
+        if size <= 0:
+            return
+
+        start = time.time()
+        connections = []
+        try:
+            for _ in range(size):
+                try:
+                    connections.append(engine.connect())
+                    if query:
+                        connections[-1].execute(query)
+                except Exception as e:
+                    self.bus.log("Warming up SQLAlchemy engine %r failed: %s" % (engine.url, e),
+                                 level=logging.WARNING)
+                    break
+        finally:
+            for connection in connections:
+                connection.close()
+
+        self.bus.log("SQLAlchemy engine %r warmed up with %d connection(s) in %.3fs"
+                     % (engine.url, len(connections), time.time() - start))
+
+    def _configure_shards(self, engine_from_config, section_name, section, replicas,
+                          pool_metrics, warmups):
+        section = dict(section)
+        shards = section.pop("shards")
+        if not isinstance(shards, dict) or not shards:
+            raise BlueberryPyConfigurationError("The 'shards' option of the [%s] section must "
+                                                "map shard ids to engines." % section_name)
+
+        shard_choosers = {}
+        for chooser in ("shard_chooser", "id_chooser", "query_chooser"):
+            chooser_fqn = section.pop(chooser, None)
+            if not chooser_fqn:
+                raise BlueberryPyConfigurationError("The [%s] section must have a %r option "
+                                                    "with its shards." % (section_name, chooser))
+            chooser_mod_name, _, chooser_name = chooser_fqn.rpartition('.')
+            try:
+                chooser_mod = importlib.import_module(chooser_mod_name)
+                shard_choosers[chooser] = getattr(chooser_mod, chooser_name)
+            except (ImportError, ValueError, AttributeError) as e:
+                raise BlueberryPyConfigurationError("Could not import %r, the %r option of the "
+                                                    "[%s] section: %s" %
+                                                    (chooser_fqn, chooser, section_name, e))
+
+        shard_engines = {}
+        for shard_id, shard_section in shards.items():
+            if not isinstance(shard_section, dict):
+                shard_section = {"url": shard_section}
+            shard_engines[shard_id] = self._create_engine(engine_from_config,
+                                                          dict(section, **shard_section),
+                                                          "shard %s" % shard_id,
+                                                          replicas, pool_metrics, warmups)
+
+        self.bus.log("SQLAlchemy shard engines configured")
+        return shard_engines, shard_choosers
@@ -3,18 +3,40 @@ try:
 except ImportError:
     import pickle
 
+import binascii
+import hashlib
 import logging
 import math
+import os
+import random
 import threading
+import time
+import weakref
+import zlib
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from pprint import pformat
 
+import cherrypy
+
+from cherrypy.lib import locking
 from cherrypy.lib.sessions import Session
-from redis import StrictRedis as _RedisClient
+from redis import BlockingConnectionPool, StrictRedis as _RedisClient, UnixDomainSocketConnection
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
-__all__ = ["RedisSession"]
+from blueberrypy import jsonlib
+
+
+__all__ = ["RedisSession", "Codec", "register_serializer", "register_compressor"]
 
 
 logger = logging.getLogger(__name__)
@@ -30,14 +52,173 @@ def normalize_sep(prefix, sep=':'):
         return prefix.rstrip(':') + ':'
 
 
+class _LocalLock(object):
+    """A re-entrant lock for one session id.
+
+    `generation` is incremented every time the session data is written or
+    deleted by this process, so data read before the lock was acquired can be
+    checked for staleness.
+    """
+
+    __slots__ = ("lock", "generation", "__weakref__")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.generation = 0
+
+    def acquire(self):
+        self.lock.acquire()
+
+    def release(self):
+        self.lock.release()
+
+
+_ACQUIRE_LOCK_SCRIPT = """
+if redis.call("set", KEYS[1], ARGV[1], "nx", "px", ARGV[2]) then
+    return {1, redis.call("get", KEYS[2]), redis.call("pttl", KEYS[2])}
+end
+return {0}
+"""
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+LOCK_RETRY_DELAY = 0.005
+LOCK_RETRY_MAX_DELAY = 0.1
+
+
+class Codec(object):
+    """A pair of functions converting session data to and from bytes.
+
+    `tag` is a single byte identifying the codec in stored session data, so
+    it must never change once data has been stored with it.
+    """
+
+    def __init__(self, name, tag, encode, decode):
+        self.name = name
+        self.tag = tag
+        self.encode = encode
+        self.decode = decode
+
+    def __repr__(self):
+        return "Codec(%r)" % self.name
+
+
+serializers = {}
+compressors = {}
+
+
+def _register(registry, codec):
+    for registered in registry.values():
+        if registered.tag == codec.tag and registered.name != codec.name:
+            raise ValueError("Tag %r is already used by %r." % (codec.tag, registered))
+    registry[codec.name] = registry[codec.tag] = codec
+
+
+def register_serializer(codec):
+    """Register a `Codec` that serializes the session data dict to bytes."""
+    _register(serializers, codec)
+
+
+def register_compressor(codec):
+    """Register a `Codec` that compresses serialized session data."""
+    _register(compressors, codec)
+
+
+register_serializer(Codec("pickle", b"p",
+                          lambda data: pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+                          pickle.loads))
+register_serializer(Codec("json", b"j", jsonlib.dumpb,
+                          lambda s: jsonlib.loads(s.decode("utf-8"))))
+if msgpack is not None:
+    register_serializer(Codec("msgpack", b"m",
+                              lambda data: msgpack.packb(data, use_bin_type=True),
+                              lambda s: msgpack.unpackb(s, raw=False)))
+
+register_compressor(Codec("zlib", b"z", zlib.compress, zlib.decompress))
+if lz4 is not None:
+    register_compressor(Codec("lz4", b"4", lz4.frame.compress, lz4.frame.decompress))
+
+# Session data stored by the codecs above starts with this marker, followed by
+# the tags of the serializer and the compressor used, or "-" if the data isn't
+# compressed. Data without it is a pickled (data, expiration_time) tuple, which
+# can't start with a NUL byte.
+_PAYLOAD_MAGIC = b"\x00\x01"
+_UNCOMPRESSED = b"-"
+
+
 class RedisSession(Session):
 
-    locks = {}
+    LOCK_SUFFIX = ".lock"
+
+    locks = weakref.WeakValueDictionary()
+    _locks_lock = threading.Lock()
 
     prefix = "cp-session:"
 
     debug = False
 
+    write_unchanged = False
+    """If False, session data that hasn't changed since it was loaded is not
+    written back to Redis, only its TTL is refreshed."""
+
+    touch_interval = 0
+    """The number of seconds after the TTL of unchanged session data was last
+    refreshed, during which it's not refreshed again. Sessions may then expire
+    up to `touch_interval` seconds earlier than `timeout`."""
+
+    lock_backend = "local"
+    """Either "local", to only lock sessions within this process, or "redis",
+    to also lock them in Redis, across all the processes sharing it."""
+
+    lock_timeout = None
+    """The number of seconds to wait for a session lock, or None to wait
+    forever. Raises `cherrypy.lib.locking.LockTimeout` when exceeded."""
+
+    lock_expire = 60
+    """The number of seconds after which a Redis session lock is released,
+    even if the process holding it never releases it."""
+
+    count_interval = 10
+    """The number of seconds the number of active sessions is cached for."""
+
+    _count = None
+    _counted_at = 0
+    _count_lock = threading.Lock()
+
+    blocking_pool = False
+    """If True, requests wait up to `pool_timeout` seconds for a connection
+    when `max_connections` connections are already in use, instead of failing
+    right away."""
+
+    pool_timeout = 20
+
+    stats_channel = "redis.pool_stats"
+    """The bus channel `pool_stats` is published to, for
+    `blueberrypy.plugins.PoolStatus`."""
+
+    codec = "pickle"
+    """The name of the serializer used to store session data. "pickle" and
+    "json" are always available, "msgpack" when msgpack is installed."""
+
+    compression = None
+    """The name of the compressor used on stored session data larger than
+    `compress_threshold` bytes, "zlib" or "lz4" when lz4 is installed."""
+
+    compress_threshold = 1024
+
+    # All the other options, such as `max_connections`, `unix_socket_path`,
+    # `socket_keepalive` or `health_check_interval`, are passed to the Redis
+    # client.
+    _options = frozenset(["write_unchanged", "touch_interval", "lock_backend",
+                          "lock_timeout", "lock_expire", "count_interval",
+                          "blocking_pool", "pool_timeout", "locking", "codec",
+                          "compression", "compress_threshold", "stats_channel"])
+
     @classmethod
     def setup(cls, **kwargs):
 
@@ -45,47 +226,288 @@ class RedisSession(Session):
 
         for k, v in kwargs.viewitems():
             setattr(cls, k, v)
-        cls.cache = cache = _RedisClient(**kwargs)
-        redis_info = cache.info()
+        if cls.codec not in serializers:
+            raise ValueError("Unknown session codec %r." % cls.codec)
+        if cls.compression and cls.compression not in compressors:
+            raise ValueError("Unknown session compression %r." % cls.compression)
+
+        client_kwargs = dict((k, v) for k, v in kwargs.viewitems() if k not in cls._options)
+        cls.cache = cache = cls._create_client(**client_kwargs)
+        cls._acquire_lock_script = cache.register_script(_ACQUIRE_LOCK_SCRIPT)
+        cls._release_lock_script = cache.register_script(_RELEASE_LOCK_SCRIPT)
+        cherrypy.engine.subscribe(cls.stats_channel, cls._publish_pool_stats)
         if cls.debug:
-            logger.info("Redis server ready.\n%s" % pformat(redis_info))
+            logger.info("Redis server ready.\n%s" % pformat(cache.info()))
         else:
+            cache.ping()
             logger.info("Redis server ready.")
 
+    @classmethod
+    def _create_client(cls, **kwargs):
+        if not cls.blocking_pool:
+            return _RedisClient(**kwargs)
+
+        unix_socket_path = kwargs.pop("unix_socket_path", None)
+        if unix_socket_path:
+            kwargs.pop("host", None)
+            kwargs.pop("port", None)
+            kwargs.update(path=unix_socket_path, connection_class=UnixDomainSocketConnection)
+        kwargs.setdefault("max_connections", 50)
+        pool = BlockingConnectionPool(timeout=cls.pool_timeout, **kwargs)
+        return _RedisClient(connection_pool=pool)
+
+    @classmethod
+    def pool_stats(cls):
+        """Return a dict of the connection pool's utilization.
+
+        `max_connections` is None if the pool is unbounded. `created` is the
+        number of connections opened so far, of which `in_use` are currently
+        used by a request and `idle` are available.
+        """
+        # The pools don't expose these, and their attributes differ between
+        # redis-py versions.
+        pool = cls.cache.connection_pool
+        max_connections = getattr(pool, "max_connections", None)
+        if isinstance(pool, BlockingConnectionPool):
+            created = len(getattr(pool, "_connections", ()))
+            queue = getattr(getattr(pool, "pool", None), "queue", ())
+            idle = len([c for c in list(queue) if c is not None])
+        else:
+            created = getattr(pool, "_created_connections", 0)
+            idle = len(getattr(pool, "_available_connections", ()))
+            if max_connections is not None and max_connections >= 2 ** 31:
+                max_connections = None
+        return {"max_connections": max_connections,
+                "created": created,
+                "in_use": created - idle,
+                "idle": idle}
+
+    @classmethod
+    def _publish_pool_stats(cls):
+        return [dict(cls.pool_stats(), name="sessions")]
+
+    def _get_lock(self):
+        # The locks are only weakly referenced by `locks`, so they are
+        # discarded as soon as no session uses them anymore.
+        with self._locks_lock:
+            lock = self.locks.get(self.id)
+            if lock is None:
+                lock = self.locks[self.id] = _LocalLock()
+        self._local_lock = lock
+        return lock
+
+    def _fetch(self):
+        # Remember which write the data was read after, so _load() can tell
+        # whether it's still current.
+        generation = self._get_lock().generation
+        key = self.prefix + self.id
+        if self.touch_interval:
+            pipe = self.cache.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.pttl(key)
+            data, pttl = pipe.execute()
+        else:
+            data, pttl = self.cache.get(key), None
+        # Unless the controller locks the session itself, the tool locks it
+        # right after the data is first fetched, before anything reads it.
+        self._fetched = (self.id, generation, data, pttl,
+                         self.locked or not self._locks_explicitly())
+
+    def _locks_explicitly(self):
+        request_config = getattr(cherrypy.serving.request, "config", None) or {}
+        return request_config.get("tools.sessions.locking", "implicit") == "explicit"
+
     def _exists(self):
-        return self.cache.exists(self.prefix + self.id)
+        if self.lock_backend == "redis" and not self._locks_explicitly():
+            # The data is fetched along with the Redis lock, right after.
+            return bool(self.cache.exists(self.prefix + self.id))
+        # Otherwise the session data is fetched along with the existence
+        # check, since it's very likely to be loaded right after.
+        self._fetch()
+        return self._fetched[2] is not None
+
+    def _encode(self, data, expiration_time):
+        if self.codec == "pickle" and not self.compression:
+            # The format all versions can read.
+            return pickle.dumps((data, expiration_time), pickle.HIGHEST_PROTOCOL)
+
+        serializer = serializers[self.codec]
+        body = serializer.encode(data)
+        compressor_tag = _UNCOMPRESSED
+        if self.compression and len(body) >= self.compress_threshold:
+            compressor = compressors[self.compression]
+            body = compressor.encode(body)
+            compressor_tag = compressor.tag
+        return b"".join([_PAYLOAD_MAGIC, serializer.tag, compressor_tag, body])
+
+    @staticmethod
+    def _decode(payload):
+        if not payload.startswith(_PAYLOAD_MAGIC):
+            return pickle.loads(payload)[0]
+
+        offset = len(_PAYLOAD_MAGIC)
+        serializer_tag = payload[offset:offset + 1]
+        compressor_tag = payload[offset + 1:offset + 2]
+        body = payload[offset + 2:]
+        if compressor_tag != _UNCOMPRESSED:
+            body = compressors[compressor_tag].decode(body)
+        return serializers[serializer_tag].decode(body)
+
+    @staticmethod
+    def _fingerprint(data):
+        return hashlib.sha1(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)).digest()
+
+    def _is_fresh(self):
+        """Return True if the TTL of the loaded data was refreshed less than
+        `touch_interval` seconds ago."""
+        pttl = getattr(self, "_loaded_pttl", None)
+        if (not self.touch_interval or pttl is None or pttl < 0 or
+                getattr(self, "_loaded_id", None) != self.id):
+            return False
+        return self.timeout * 60000 - pttl < self.touch_interval * 1000
 
     def _load(self):
-        data = self.cache.get(self.prefix + self.id)
+        # The generation only tells writes by this process apart, so data
+        # fetched before the session was locked may have been changed by
+        # another process since. The Redis lock fetches it again once acquired.
+        fetched = getattr(self, "_fetched", None)
+        if (fetched is None or fetched[:2] != (self.id, self._get_lock().generation) or
+                (self.locked and not fetched[4])):
+            self._fetch()
+        data, self._loaded_pttl = self._fetched[2:4]
+        self._fetched = None
+        # The session is saved under another id if it's regenerated.
+        self._loaded_id = self.id
+
         if data:
-            return pickle.loads(data)
+            data = self._decode(data)
+            if not self.write_unchanged:
+                self._loaded_fingerprint = self._fingerprint(data)
+            # Redis expires the key by itself, so data that is still there
+            # hasn't expired, even if only its TTL was refreshed since it was
+            # last written.
+            return data, datetime.max
 
     def _save(self, expiration_time):
         key = self.prefix + self.id
         seconds = int(math.ceil((expiration_time - datetime.now()).total_seconds()))
-        data = pickle.dumps((self._data, expiration_time), pickle.HIGHEST_PROTOCOL)
 
-        reply = self.cache.setex(key, seconds, data)
-        if not reply:
-            logger.error("Redis didn't reply for SETEX '{0}' '{1}' data".format(
-                key, seconds))
+        unchanged = False
+        if not self.write_unchanged:
+            loaded_fingerprint = getattr(self, "_loaded_fingerprint", None)
+            unchanged = (loaded_fingerprint is not None and
+                         getattr(self, "_loaded_id", None) == self.id and
+                         self._fingerprint(self._data) == loaded_fingerprint)
+            if unchanged and self._is_fresh():
+                return
+
+        # Release the Redis lock in the same round trip, release_lock() only
+        # has to release the local lock then.
+        redis_lock = getattr(self, "_redis_lock", None)
+        client = self.cache.pipeline(transaction=False) if redis_lock else self.cache
+        if unchanged:
+            reply = client.expire(key, seconds)
+        else:
+            reply = client.setex(key, seconds, self._encode(self._data, expiration_time))
+        if redis_lock:
+            self._release_redis_lock(client)
+            reply, released = client.execute()
+            if not released:
+                logger.warning("Redis lock '{0}' expired before it was released".format(
+                    redis_lock[0]))
+
+        if unchanged:
+            if not reply and self.debug:
+                logger.debug("Session '{0}' was gone before its TTL could be refreshed".format(key))
+        else:
+            self._get_lock().generation += 1
+            if not reply:
+                logger.error("Redis didn't reply for SETEX '{0}' '{1}' data".format(
+                    key, seconds))
 
     def _delete(self):
         self.cache.delete(self.prefix + self.id)
+        self._get_lock().generation += 1
+
+    def _acquire_redis_lock(self):
+        lock_timeout = self.lock_timeout
+        if isinstance(lock_timeout, (int, float)):
+            lock_timeout = timedelta(seconds=lock_timeout)
+        checker = locking.LockChecker(self.id, lock_timeout)
+
+        key = self.prefix + self.id + self.LOCK_SUFFIX
+        token = binascii.hexlify(os.urandom(16))
+        generation = self._get_lock().generation
+        delay = LOCK_RETRY_DELAY
+        while not checker.expired():
+            # The session data is fetched as soon as the lock is acquired, so
+            # it doesn't have to be fetched again by _load().
+            reply = self._acquire_lock_script(
+                keys=[key, self.prefix + self.id],
+                args=[token, int(self.lock_expire * 1000)])
+            if reply[0]:
+                self._redis_lock = (key, token)
+                self._fetched = (self.id, generation, reply[1],
+                                 reply[2] if self.touch_interval else None, True)
+                return
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, LOCK_RETRY_MAX_DELAY)
+
+    def _release_redis_lock(self, client=None):
+        key, token = self._redis_lock
+        self._redis_lock = None
+        return self._release_lock_script(keys=[key], args=[token], client=client)
 
     def acquire_lock(self):
         """Acquire an exclusive lock on the currently-loaded session data."""
         self.locked = True
-        self.locks.setdefault(self.id, threading.RLock()).acquire()
+        self._acquired_lock = lock = self._get_lock()
+        lock.acquire()
+        if self.lock_backend == "redis":
+            try:
+                self._acquire_redis_lock()
+            except Exception:
+                lock.release()
+                self.locked = False
+                raise
         if self.debug:
-            logger.debug('Lock acquired.', 'TOOLS.SESSIONS')
+            logger.debug("Lock acquired.")
 
     def release_lock(self):
         """Release the lock on the currently-loaded session data."""
-        self.locks[self.id].release()
+        redis_lock = getattr(self, "_redis_lock", None)
+        if redis_lock and not self._release_redis_lock():
+            logger.warning("Redis lock '{0}' expired before it was released".format(
+                redis_lock[0]))
+        self._acquired_lock.release()
+        self._acquired_lock = self._local_lock = None
         self.locked = False
 
+    def _count_sessions(self):
+        # SCAN doesn't block the server like KEYS does, and the keys don't
+        # have to be held in memory all at once.
+        lock_suffix = self.LOCK_SUFFIX.encode("ascii")
+        count = 0
+        for key in self.cache.scan_iter(match=self.prefix + "*", count=1000):
+            if not key.endswith(lock_suffix):
+                count += 1
+        return count
+
     def __len__(self):
-        """Return the number of active sessions."""
-        keys = self.cache.keys(self.prefix + '*')
-        return len(keys)
+        """Return the number of active sessions.
+
+        The result is cached for `count_interval` seconds. While it's being
+        refreshed, other threads get the previous result.
+        """
+        cls = self.__class__
+        if cls._count is not None and time.time() - cls._counted_at < self.count_interval:
+            return cls._count
+
+        if not cls._count_lock.acquire(cls._count is None):
+            return cls._count
+        try:
+            cls._count = self._count_sessions()
+            cls._counted_at = time.time()
+        finally:
+            cls._count_lock.release()
+        return cls._count
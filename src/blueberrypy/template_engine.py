@@ -1,19 +1,52 @@
+import hashlib
+import logging
+import os
+import re
+import sys
+import zipfile
+
 from jinja2 import Environment as Jinja2Environment
+from jinja2.loaders import ChoiceLoader, FileSystemLoader, ModuleLoader
+from jinja2.bccache import Bucket, BytecodeCache, bc_version
 
 from blueberrypy.exc import BlueberryPyNotConfiguredError
 
-__all__ = ["jinja2_env", "configure_jinja2", "get_template"]
+__all__ = ["jinja2_env", "configure_jinja2", "get_template", "RedisBytecodeCache",
+           "warm_bytecode_cache", "compile_templates"]
+
+
+logger = logging.getLogger(__name__)
 
 
 jinja2_env = None
 
 
 def configure_jinja2(assets_env=None, **kwargs):
+    """Set up the Jinja2 environment used by `get_template`.
+
+    The keyword arguments are passed to `jinja2.Environment`, except
+    `precompiled`, the directory or zip archive the templates were compiled
+    to by `compile_templates`. If given, the templates are loaded from the
+    Python modules there, without parsing their source, and the configured
+    `loader`, if any, is only used for the templates that weren't compiled.
+    """
     global jinja2_env
 
     autoescape = kwargs.pop("autoescape", False)
     extensions = kwargs.pop("extensions", [])
     global_functions = kwargs.pop("globals", None)
+    precompiled = kwargs.pop("precompiled", None)
+
+    loader = kwargs.get("loader")
+    # A FileSystemLoader loaded from YAML skips its constructor, and so misses
+    # the attributes it defaults, which list_templates() needs.
+    if isinstance(loader, FileSystemLoader):
+        loader.followlinks = getattr(loader, "followlinks", False)
+
+    if precompiled:
+        kwargs["loader"] = ModuleLoader(precompiled)
+        if loader is not None:
+            kwargs["loader"] = ChoiceLoader([kwargs["loader"], loader])
 
     if assets_env:
         from webassets.ext.jinja2 import AssetsExtension
@@ -39,3 +72,183 @@ def get_template(*args, **kwargs):
     if not jinja2_env:
         raise BlueberryPyNotConfiguredError("Jinja2 not configured")
     return jinja2_env.get_template(*args, **kwargs)
+
+
+class RedisBytecodeCache(BytecodeCache):
+    """A Jinja2 bytecode cache stored in Redis, shared by every process and
+    host using the same Redis server.
+
+    The bytecode of a template is keyed by its name and the checksum of its
+    source, not by its path, so hosts with the templates at different paths
+    share it, and a changed template never loads the bytecode of its previous
+    version. The keys expire after `timeout` seconds if given, so the
+    bytecode of templates that aren't deployed anymore eventually goes away.
+
+    Unless a `client`, or the parameters of a `redis.StrictRedis` to connect
+    with, are given, the Redis client of `blueberrypy.session.RedisSession`
+    is used, and the templates are compiled without the cache until the
+    sessions are set up.
+
+    Redis errors are logged, and the templates compiled as if they weren't
+    cached.
+
+    Example::
+
+        jinja2:
+          bytecode_cache: !!python/object:blueberrypy.template_engine.RedisBytecodeCache
+                          {prefix: "myproject:jinja2:", timeout: 604800}
+    """
+
+    prefix = "jinja2:bytecode:"
+    timeout = None
+    connection = None
+    _client = None
+
+    # Bytecode only loads on the Python version that compiled it.
+    bytecode_version = "%d.%d.%d" % ((bc_version,) + sys.version_info[:2])
+
+    def __init__(self, client=None, prefix=None, timeout=None, **connection):
+        self._client = client
+        if prefix is not None:
+            self.prefix = prefix
+        self.timeout = timeout
+        self.connection = connection or None
+
+    @property
+    def client(self):
+        if self._client is None and self.connection:
+            from redis import StrictRedis
+            self._client = StrictRedis(**self.connection)
+        if self._client is not None:
+            return self._client
+
+        from blueberrypy.session import RedisSession
+        return getattr(RedisSession, "cache", None)
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        key = "%s%s:%s:%s" % (self.prefix, self.bytecode_version,
+                              hashlib.sha1(name.encode("utf-8")).hexdigest(), checksum)
+        bucket = Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket):
+        client = self.client
+        if client is None:
+            return
+        try:
+            code = client.get(bucket.key)
+        except Exception as e:
+            logger.warning("Could not load the bytecode of %s from Redis: %s", bucket.key, e)
+            return
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        client = self.client
+        if client is None:
+            return
+        try:
+            if self.timeout:
+                client.setex(bucket.key, self.timeout, bucket.bytecode_to_string())
+            else:
+                client.set(bucket.key, bucket.bytecode_to_string())
+        except Exception as e:
+            logger.warning("Could not save the bytecode of %s to Redis: %s", bucket.key, e)
+
+    def clear(self):
+        client = self.client
+        if client is None:
+            return
+        keys = list(client.scan_iter(match=self.prefix + "*", count=1000))
+        if keys:
+            client.delete(*keys)
+
+
+def warm_bytecode_cache(env=None, extensions=None):
+    """Compile all the templates of `env` into its bytecode cache.
+
+    `env` defaults to the environment set up by `configure_jinja2`. If
+    `extensions` is given, only the templates with those file extensions are
+    compiled.
+
+    Returns the list of the names of the templates compiled, or found in the
+    cache already, and a dict of the names of those that couldn't be compiled
+    to their exceptions.
+    """
+    env = env or jinja2_env
+    if env is None:
+        raise BlueberryPyNotConfiguredError("Jinja2 not configured")
+    if env.bytecode_cache is None:
+        raise BlueberryPyNotConfiguredError("Jinja2 bytecode cache not configured")
+
+    compiled, failed = [], {}
+    for name in env.list_templates(extensions=extensions):
+        try:
+            # Loaded straight from the loader, which goes through the bytecode
+            # cache, instead of the environment's own cache of templates.
+            env.loader.load(env, name)
+        except Exception as e:
+            failed[name] = e
+        else:
+            compiled.append(name)
+    return compiled, failed
+
+
+# The names ModuleLoader.get_module_filename gives the modules, and those of
+# the files Python compiles them to when they are imported.
+_module_filename = re.compile(r"^tmpl_[0-9a-f]{40}\.py[co]?$")
+
+
+def compile_templates(target, env=None, extensions=None):
+    """Compile all the templates of `env` to Python modules in `target`.
+
+    `target` is a directory, created if it doesn't exist, or a zip archive if
+    it ends with ".zip". Either can be given as the `precompiled` option of
+    `configure_jinja2` to load the templates from. `env` and `extensions` are
+    the same as for `warm_bytecode_cache`. The modules compiled to `target`
+    before are removed first, so that those of the templates since removed or
+    renamed aren't loaded anymore.
+
+    Returns the list of the names of the templates compiled, and a dict of
+    the names of those that couldn't be compiled to their exceptions.
+    """
+    env = env or jinja2_env
+    if env is None:
+        raise BlueberryPyNotConfiguredError("Jinja2 not configured")
+
+    if target.endswith(".zip"):
+        archive = zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED)
+
+        def write_module(filename, data):
+            archive.writestr(filename, data)
+    else:
+        archive = None
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for filename in os.listdir(target):
+            if _module_filename.match(filename):
+                os.remove(os.path.join(target, filename))
+
+        def write_module(filename, data):
+            with open(os.path.join(target, filename), "wb") as f:
+                f.write(data)
+
+    compiled, failed = [], {}
+    try:
+        for name in env.list_templates(extensions=extensions):
+            try:
+                source, filename, _ = env.loader.get_source(env, name)
+                code = env.compile(source, name, filename, raw=True, defer_init=True)
+            except Exception as e:
+                failed[name] = e
+                continue
+            if not isinstance(code, bytes):
+                code = code.encode("utf-8")
+            write_module(ModuleLoader.get_module_filename(name), code)
+            compiled.append(name)
+    finally:
+        if archive is not None:
+            archive.close()
+    return compiled, failed
@@ -4,6 +4,7 @@ from cherrypy.test.helper import CPWebCase
 
 from blueberrypy.config import BlueberryPyConfiguration
 from blueberrypy import email
+from blueberrypy import jsonlib, jsontools
 from blueberrypy.plugins import LoggingPlugin
 from blueberrypy.session import RedisSession
 from blueberrypy.plugins import SQLAlchemyPlugin
@@ -36,6 +37,11 @@ class ControllerTestCase(CPWebCase):
                                                           config=config.sqlalchemy_config)
             cherrypy.tools.orm_session = SQLAlchemySessionTool()
 
+        if config.json_config.get("backend"):
+            jsonlib.set_backend(config.json_config["backend"])
+        if config.json_config.get("tools"):
+            jsontools.setup_tools()
+
         if config.use_jinja2:
             if config.webassets_env:
                 configure_jinja2(assets_env=config.webassets_env,
@@ -1,6 +1,6 @@
 import cherrypy
 
-from blueberrypy.plugins import SQLAlchemyPlugin
+from blueberrypy.plugins import SQLAlchemyPlugin, SQLAlchemyPoolStatus
 
 
 class EngineTest(object):
@@ -9,6 +9,10 @@ class EngineTest(object):
         return str(cherrypy.engine.sqlalchemy.engine)
     engine.exposed = True
 
+    def query(self):
+        return str(cherrypy.engine.sqlalchemy.engine.scalar("SELECT 1"))
+    query.exposed = True
+
     def exit(self):
         # This handler might be called before the engine is STARTED if an
         # HTTP worker thread handles it before the HTTP server returns
@@ -30,3 +34,4 @@ cherrypy.engine.sqlalchemy = SQLAlchemyPlugin(cherrypy.engine, saconf)
 cherrypy.config.update({'environment': 'test_suite',
                         'engine.sqlalchemy.on': True})
 cherrypy.tree.mount(EngineTest())
+cherrypy.tree.mount(SQLAlchemyPoolStatus(), "/pool_status")
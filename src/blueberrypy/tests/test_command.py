@@ -2,7 +2,9 @@ import __builtin__ as builtins
 import datetime
 import os.path
 import re
+import shutil
 import sys
+import tempfile
 import unittest
 import textwrap
 
@@ -173,6 +175,7 @@ class ServeCommandTest(unittest.TestCase):
     def setUpClass(cls):
         cls.old_sys_argv = sys.argv
         cls.old_cherrypy_server_bind_addr = cherrypy.server.bind_addr
+        cls.old_json_tools = cherrypy.tools.json_in, cherrypy.tools.json_out
 
     def setUp(self):
         self.old_exists = os.path.exists
@@ -200,6 +203,9 @@ class ServeCommandTest(unittest.TestCase):
         if blueberrypy.template_engine.jinja2_env is not None:
             blueberrypy.template_engine.jinja2_env = None
 
+        cherrypy.tools.json_in, cherrypy.tools.json_out = self.old_json_tools
+        blueberrypy.jsonlib._backend = blueberrypy.jsonlib._compatible_backend = None
+
         # restore stuff
         sys.argv = self.old_sys_argv
         cherrypy.server.bind_addr = self.old_cherrypy_server_bind_addr
@@ -385,6 +391,33 @@ class ServeCommandTest(unittest.TestCase):
         self.assertTrue(not hasattr(cherrypy.tools, "orm_session"))
         self.assertIsInstance(blueberrypy.template_engine.jinja2_env, jinja2.Environment)
 
+    def test_setup_json(self):
+        self._setup_basic_app_config()
+        sys.argv = ("blueberrypy -C /tmp serve").split()
+        main()
+        self.assertEqual(self.old_json_tools, (cherrypy.tools.json_in, cherrypy.tools.json_out))
+        self.assertIn(blueberrypy.jsonlib.get_backend().name, ("simplejson", "json"))
+
+        app_yml_file = FakeFile(textwrap.dedent("""
+        global:
+            environment: test_suite
+        controllers:
+            '':
+                controller: !!python/name:blueberrypy.tests.test_command.Root
+        json:
+            backend: json
+            tools: true
+        """))
+
+        path_file_mapping = {"/tmp/dev/app.yml": app_yml_file}
+        self._stub_out_path_and_open(path_file_mapping)
+
+        sys.argv = ("blueberrypy -C /tmp serve").split()
+        main()
+        self.assertIs(blueberrypy.jsontools.json_in, cherrypy.tools.json_in.callable)
+        self.assertIs(blueberrypy.jsontools.json_out, cherrypy.tools.json_out.callable)
+        self.assertEqual("json", blueberrypy.jsonlib.get_backend().name)
+
     def test_setup_webassets(self):
         app_yml_file = FakeFile(textwrap.dedent("""
         global:
@@ -585,3 +618,52 @@ class ServeCommandTest(unittest.TestCase):
             self.assertEqual(cherrypy.server.bind_addr, ("0.0.0.0", 9090))
         finally:
             cherrypy.engine.start = old_cherrypy_engine_start
+
+
+class TemplatesCommandTest(unittest.TestCase):
+
+    app_yml = textwrap.dedent("""
+    global:
+        environment: test_suite
+    controllers:
+        '':
+            controller: !!python/name:blueberrypy.tests.test_command.Root
+    jinja2:
+        loader: !!python/object:jinja2.loaders.DictLoader
+                mapping: %s
+    """)
+
+    def setUp(self):
+        self.old_sys_argv = sys.argv
+        self.config_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.config_dir, "dev"))
+        self.target = os.path.join(self.config_dir, "templates")
+
+    def tearDown(self):
+        sys.argv = self.old_sys_argv
+        shutil.rmtree(self.config_dir)
+
+    def _write_app_config(self, mapping):
+        with open(os.path.join(self.config_dir, "dev", "app.yml"), "w") as f:
+            f.write(self.app_yml % mapping)
+
+    def test_compile(self):
+        self._write_app_config('{"index.html": "<h1>{{ title }}</h1>", "mail.txt": "Hi"}')
+        sys.argv = ("blueberrypy -C %s templates compile -x html %s" %
+                    (self.config_dir, self.target)).split()
+        main()
+
+        self.assertEqual([jinja2.ModuleLoader.get_module_filename("index.html")],
+                         os.listdir(self.target))
+
+    def test_compile_failed(self):
+        self._write_app_config('{"index.html": "<h1>{{ title }}</h1>", "broken.html": "{% if %}"}')
+        sys.argv = ("blueberrypy -C %s templates compile %s" %
+                    (self.config_dir, self.target)).split()
+        with self.assertRaises(SystemExit) as cm:
+            main()
+
+        self.assertEqual(1, cm.exception.code)
+        # the templates that could be compiled still are
+        self.assertEqual([jinja2.ModuleLoader.get_module_filename("index.html")],
+                         os.listdir(self.target))
@@ -151,6 +151,22 @@ class BlueberryPyConfigurationTest(unittest.TestCase):
         config = BlueberryPyConfiguration(app_config=app_config)
         self.assertTrue(config.use_redis)
 
+    def test_redis_session_config(self):
+        app_config = self.basic_valid_app_config.copy()
+        config = BlueberryPyConfiguration(app_config=app_config)
+        self.assertIsNone(config.redis_session_config)
+
+        app_config["controllers"][''].update({"/": {"tools.sessions.on": True,
+                                                    "tools.sessions.storage_type": "redis",
+                                                    "tools.sessions.timeout": 60,
+                                                    "tools.sessions.host": "redis.local",
+                                                    "tools.sessions.prefix": "myproject:",
+                                                    "tools.staticdir.root": "/tmp"}})
+
+        config = BlueberryPyConfiguration(app_config=app_config)
+        self.assertEqual({"host": "redis.local", "prefix": "myproject:"},
+                         config.redis_session_config)
+
     def test_use_sqlalchemy(self):
         app_config = self.basic_valid_app_config.copy()
         app_config.update({"global": {"engine.sqlalchemy.on": True}})
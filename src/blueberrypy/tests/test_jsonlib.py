@@ -0,0 +1,84 @@
+import json
+import unittest
+
+from decimal import Decimal
+
+from blueberrypy import jsonlib
+
+
+class JSONLibTest(unittest.TestCase):
+
+    def setUp(self):
+        self._loaders = jsonlib._loaders[:]
+        jsonlib._backend = jsonlib._compatible_backend = None
+
+    def tearDown(self):
+        jsonlib._loaders[:] = self._loaders
+        jsonlib._backend = jsonlib._compatible_backend = None
+
+    def _register_limited_backend(self):
+        calls = []
+
+        def dumps(obj):
+            if isinstance(obj, Decimal):
+                raise TypeError(obj)
+            calls.append(obj)
+            return json.dumps(obj, separators=(",", ":"))
+
+        def loads(s):
+            calls.append(s)
+            return json.loads(s)
+
+        jsonlib.register_backend("limited",
+                                 lambda: jsonlib.JSONBackend("limited", dumps, loads,
+                                                             dumps_kwargs=(), loads_kwargs=(),
+                                                             item_separator=","),
+                                 first=True)
+        return calls
+
+    def test_dumps_loads(self):
+        doc = {"a": [1, 2.5, None, True], "b": {"c": u"d"}}
+        self.assertEqual(doc, jsonlib.loads(jsonlib.dumps(doc)))
+        self.assertEqual(doc, jsonlib.loads(jsonlib.dumpb(doc).decode("utf-8")))
+        self.assertTrue(isinstance(jsonlib.dumpb(doc), bytes))
+        self.assertTrue(jsonlib.dumps({"b": 2, "a": 1}, sort_keys=True).startswith('{"a"'))
+
+    def test_register_backend(self):
+        calls = self._register_limited_backend()
+        self.assertIn(jsonlib.get_backend().name, ("simplejson", "json"))
+        self.assertEqual("limited", jsonlib.set_backend("fastest").name)
+        self.assertEqual("limited", jsonlib.get_backend().name)
+        self.assertEqual('{"a":1}', jsonlib.dumps({"a": 1}))
+        self.assertEqual({"a": 1}, jsonlib.loads('{"a": 1}'))
+        self.assertEqual(2, len(calls))
+
+    def test_fallback(self):
+        calls = self._register_limited_backend()
+        jsonlib.set_backend("limited")
+
+        # unsupported keyword arguments
+        self.assertEqual('{"a": 1}', jsonlib.dumps({"a": 1}, sort_keys=True))
+        self.assertEqual({"a": 2}, jsonlib.loads('{"a": 1}',
+                                                 object_hook=lambda o: dict((k, 2) for k in o)))
+
+        # unsupported values
+        self.assertEqual(float(jsonlib.dumps(Decimal("1.5"), default=float)), 1.5)
+        self.assertEqual([], calls)
+
+    def test_set_backend(self):
+        self._register_limited_backend()
+        self.assertEqual("json", jsonlib.set_backend("json").name)
+        self.assertEqual('{"a": 1}', jsonlib.dumps({"a": 1}))
+        self.assertRaises(ValueError, jsonlib.set_backend, "nonexistent")
+
+    def test_dump_chunks(self):
+        self.assertEqual([jsonlib.dumps({"a": 1})], list(jsonlib.dump_chunks({"a": 1})))
+        self.assertEqual([jsonlib.dumps([1, 2])], list(jsonlib.dump_chunks([1, 2])))
+        self.assertEqual("[]", "".join(jsonlib.dump_chunks(iter([]))))
+
+        values = [{"i": i} for i in range(5000)]
+        chunks = list(jsonlib.dump_chunks(iter(values)))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(jsonlib.dumps(values), "".join(chunks))
+        self.assertEqual(json.dumps(values, separators=(",", ":")),
+                         "".join(jsonlib.dump_chunks(iter(values), separators=(",", ":"))))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+import cherrypy
+from cherrypy.test import helper
+
+from blueberrypy import jsontools
+
+
+class JSONToolsTest(helper.CPWebCase, unittest.TestCase):
+
+    @staticmethod
+    def setup_server():
+
+        class Root(object):
+
+            @cherrypy.expose
+            @cherrypy.tools.json_out()
+            def plain(self):
+                return {"a": [1, 2], "b": u"褔"}
+
+            @cherrypy.expose
+            @cherrypy.tools.json_in()
+            @cherrypy.tools.json_out()
+            def echo(self):
+                return cherrypy.request.json
+
+        jsontools.setup_tools()
+        cherrypy.tree.mount(Root())
+
+    def test_json_out(self):
+        self.getPage("/plain")
+        self.assertStatus(200)
+        self.assertHeader("Content-Type", "application/json")
+        self.assertEqual({"a": [1, 2], "b": u"褔"}, json.loads(self.body.decode("utf-8")))
+
+    def test_json_in(self):
+        body = b'{"a": [1, 2]}'
+        self.getPage("/echo", method="POST", body=body,
+                     headers=[("Content-Type", "application/json"),
+                              ("Content-Length", str(len(body)))])
+        self.assertStatus(200)
+        self.assertEqual({"a": [1, 2]}, json.loads(self.body.decode("utf-8")))
+
+        body = b'{"a": '
+        self.getPage("/echo", method="POST", body=body,
+                     headers=[("Content-Type", "application/json"),
+                              ("Content-Length", str(len(body)))])
+        self.assertStatus(400)
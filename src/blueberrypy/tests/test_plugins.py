@@ -1,7 +1,22 @@
 import os
+import shutil
+import tempfile
+import time
+import unittest
 
+import cherrypy
+from cherrypy.process.plugins import DropPrivileges
+from cherrypy.process.wspbus import Bus
 from cherrypy.test import helper
 
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+from blueberrypy import jsonlib
+from blueberrypy.exc import BlueberryPyConfigurationError
+from blueberrypy.plugins import ReplicaSet, SQLAlchemyPlugin
+
 
 class SQLAlchemyPluginTest(helper.CPWebCase):
 
@@ -39,3 +54,259 @@ class SQLAlchemyPluginTest(helper.CPWebCase):
         finally:
             self.getPage("/exit")
         p.join()
+
+    def test_pool_status(self):
+        if os.name not in ['posix']:
+            return self.skip("skipped (not on posix) ")
+
+        p = helper.CPProcess(ssl=(self.scheme.lower() == 'https'))
+        p.write_conf(extra='test_case_name: "test_pool_status"')
+        p.start(imports='blueberrypy.tests._test_plugins_engine')
+
+        try:
+            self.getPage("/query")
+            self.assertStatus(200)
+            self.getPage("/query")
+            self.assertStatus(200)
+
+            self.getPage("/pool_status/")
+            self.assertStatus(200)
+            self.assertHeader("Content-Type", "application/json")
+            stats = jsonlib.loads(self.body.decode())
+            self.assertEqual(1, len(stats))
+            self.assertEqual("sqlalchemy_engine", stats[0]["name"])
+            self.assertEqual("sqlite://", stats[0]["url"])
+            self.assertTrue(stats[0]["healthy"])
+            self.assertEqual(2, stats[0]["checkouts"])
+            self.assertEqual(0, stats[0]["checked_out"])
+            self.assertEqual(2, sum(bucket["count"] for bucket in stats[0]["wait_histogram"]))
+        finally:
+            self.getPage("/exit")
+        p.join()
+
+
+class ReplicaSetTest(unittest.TestCase):
+
+    def test_least_latency_failed_statements(self):
+        engines = [create_engine("sqlite://"), create_engine("sqlite://")]
+        replicas = ReplicaSet(engines, "least_latency")
+
+        conn = engines[0].connect()
+        try:
+            for i in range(3):
+                self.assertRaises(OperationalError, conn.execute, "SELECT * FROM nothing")
+            conn.execute("SELECT 1")
+            self.assertNotIn("replica_query_start_time", conn.info)
+        finally:
+            conn.close()
+        self.assertTrue(0 < replicas.latencies[engines[0]] < 1)
+        self.assertIs(engines[1], replicas.choose())
+
+    def test_least_latency_probes(self):
+        engines = [create_engine("sqlite://"), create_engine("sqlite://")]
+        replicas = ReplicaSet(engines, "least_latency")
+        replicas.latencies[engines[0]] = 10.0
+
+        chosen = [replicas.choose() for _ in range(2 * replicas.probe_interval)]
+        # Each replica is probed in turn
+        self.assertEqual(1, chosen.count(engines[0]))
+        self.assertIs(engines[0], chosen[replicas.probe_interval - 1])
+
+        # The slow replica is measured again when probed
+        conn = engines[0].connect()
+        try:
+            conn.execute("SELECT 1")
+        finally:
+            conn.close()
+        self.assertLess(replicas.latencies[engines[0]], 10.0)
+
+
+class SQLAlchemyPluginShardTest(unittest.TestCase):
+
+    def _configure(self, **section):
+        config = {"sqlalchemy_engine": dict({"shards": {"a": "sqlite://"}}, **section)}
+        plugin = SQLAlchemyPlugin(cherrypy.engine, config)
+        try:
+            plugin._configure_engines()
+        except BlueberryPyConfigurationError as e:
+            return str(e)
+        finally:
+            plugin.stop()
+
+    def test_invalid_choosers(self):
+        choosers = {"shard_chooser": "os.path.join",
+                    "id_chooser": "os.path.join",
+                    "query_chooser": "os.path.join"}
+        self.assertIsNone(self._configure(**choosers))
+
+        error = self._configure(**dict(choosers, id_chooser=None))
+        self.assertIn("[sqlalchemy_engine]", error)
+        self.assertIn("'id_chooser'", error)
+
+        for query_chooser in ("os.path.nothing", "nothing.join", "join"):
+            error = self._configure(**dict(choosers, query_chooser=query_chooser))
+            self.assertIn("[sqlalchemy_engine]", error)
+            self.assertIn("'query_chooser'", error)
+            self.assertIn(repr(query_chooser), error)
+
+        error = self._configure(shards=["sqlite://"], **choosers)
+        self.assertIn("'shards'", error)
+
+
+class SQLAlchemyPluginWarmupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(self.tmpdir, "warmup.db")
+        self.bus = Bus()
+        self.plugin = SQLAlchemyPlugin(self.bus, {
+            "sqlalchemy_engine": {"url": url,
+                                  "poolclass": QueuePool,
+                                  "warmup": 3,
+                                  "warmup_query": "SELECT 1"}})
+        self.plugin.subscribe()
+
+    def tearDown(self):
+        self.bus.exit()
+        shutil.rmtree(self.tmpdir)
+
+    def test_warmup(self):
+        # The engines are set up and warmed up before the HTTP server starts.
+        checked_in = []
+        self.bus.subscribe("start", lambda: checked_in.append(self.plugin.engine.pool.checkedin()),
+                           priority=75)
+        self.bus.start()
+        self.assertEqual([3], checked_in)
+
+        pool = self.plugin.engine.pool
+        self.assertEqual(3, pool.checkedin())
+        self.assertEqual(0, pool.checkedout())
+
+        stats = self.plugin.pool_stats()[0]
+        self.assertEqual(3, stats["connects"])
+        self.assertEqual(3, stats["checkouts"])
+        self.assertEqual(0, stats["connect_errors"])
+
+    def test_warmup_failure(self):
+        self.plugin.config["sqlalchemy_engine"]["warmup_query"] = "SELECT * FROM nothing"
+        self.bus.start()
+
+        pool = self.plugin.engine.pool
+        self.assertEqual(1, pool.checkedin())
+        self.assertEqual(0, pool.checkedout())
+
+    def test_warmup_pool_size(self):
+        self.plugin.config["sqlalchemy_engine"].update(pool_size=2, max_overflow=5,
+                                                       pool_timeout=1)
+        self.bus.start()
+
+        # No overflow connection is opened only to be closed right away
+        self.assertEqual(2, self.plugin.engine.pool.checkedin())
+        self.assertEqual(2, self.plugin.pool_stats()[0]["connects"])
+
+    @unittest.skipUnless(hasattr(os, "geteuid") and os.geteuid() == 0, "not running as root")
+    def test_warmup_dropped_privileges(self):
+        import pwd
+        nobody = pwd.getpwnam("nobody")
+        os.chmod(self.tmpdir, 0o777)
+        DropPrivileges(self.bus, uid=nobody.pw_uid, gid=nobody.pw_gid).subscribe()
+
+        # Without starting the bus, which would drop the privileges for good.
+        self.plugin.start()
+
+        self.assertEqual(0, os.geteuid())
+        self.assertEqual(3, self.plugin.engine.pool.checkedin())
+        db_stat = os.stat(os.path.join(self.tmpdir, "warmup.db"))
+        self.assertEqual((nobody.pw_uid, nobody.pw_gid), (db_stat.st_uid, db_stat.st_gid))
+
+
+class Model(object):
+    pass
+
+
+class DisposalRecordingPool(QueuePool):
+
+    disposed = []
+
+    def dispose(self):
+        self.disposed.append(self)
+        QueuePool.dispose(self)
+
+
+class SQLAlchemyPluginGracefulTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.plugin = SQLAlchemyPlugin(cherrypy.engine, self.get_config("old.db"),
+                                       reload_config=lambda: self.get_config("new.db"))
+
+    def tearDown(self):
+        self.plugin.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def get_config(self, filename):
+        return {"sqlalchemy_engine": {"url": "sqlite:///" + os.path.join(self.tmpdir, filename),
+                                      "poolclass": QueuePool,
+                                      "warmup": 2}}
+
+    def test_graceful(self):
+        self.plugin.start()
+        old_engine = self.plugin.engine
+        old_pool = old_engine.pool
+
+        connection = old_engine.connect()
+        self.plugin.graceful()
+
+        new_engine = self.plugin.engine
+        self.assertIsNot(old_engine, new_engine)
+        self.assertTrue(new_engine.url.database.endswith("new.db"))
+        self.assertEqual(2, new_engine.pool.checkedin())
+        self.assertEqual(["sqlalchemy_engine"],
+                         [stats["name"] for stats in self.plugin.pool_stats()])
+        self.assertTrue(self.plugin.pool_stats()[0]["url"].endswith("new.db"))
+
+        # The old pool isn't disposed of while a connection is in use
+        time.sleep(0.3)
+        self.assertIs(old_pool, old_engine.pool)
+        self.assertEqual(1, connection.scalar("SELECT 1"))
+
+        connection.close()
+        for _ in range(50):
+            if old_engine.pool is not old_pool:
+                break
+            time.sleep(0.1)
+        self.assertIsNot(old_pool, old_engine.pool)
+        self.assertEqual(0, old_pool.checkedin())
+
+    def test_graceful_failure(self):
+        self.plugin.start()
+        config = self.plugin.config
+        engine = self.plugin.engine
+
+        self.plugin.reload_config = lambda: {"sqlalchemy_engine": {"url": "nothing://"}}
+        self.plugin.graceful()
+
+        self.assertIs(config, self.plugin.config)
+        self.assertIs(engine, self.plugin.engine)
+        self.assertEqual(1, len(self.plugin.pool_stats()))
+
+    def test_graceful_failure_engine_bindings(self):
+        section_name = "sqlalchemy_engine_%s.Model" % __name__
+        config = {section_name: {"url": "sqlite://"}}
+        self.plugin = SQLAlchemyPlugin(cherrypy.engine, config)
+        self.plugin.start()
+        engine_bindings = self.plugin.engine_bindings
+        pool_metrics = self.plugin.pool_metrics
+
+        # The engine of the reloaded section is set up, but not its replica
+        del DisposalRecordingPool.disposed[:]
+        self.plugin.reload_config = lambda: {section_name: {"url": "sqlite://",
+                                                            "poolclass": DisposalRecordingPool,
+                                                            "replicas": "nothing://"}}
+        self.plugin.graceful()
+
+        self.assertIs(config, self.plugin.config)
+        self.assertIs(engine_bindings, self.plugin.engine_bindings)
+        self.assertEqual([Model], list(engine_bindings))
+        self.assertIs(pool_metrics, self.plugin.pool_metrics)
+        self.assertEqual(1, len(DisposalRecordingPool.disposed))
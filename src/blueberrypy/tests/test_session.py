@@ -9,6 +9,8 @@ import cherrypy
 from cherrypy.lib import sessions
 from cherrypy.test import helper
 
+from blueberrypy import jsonlib
+from blueberrypy.plugins import PoolStatus
 from blueberrypy.session import RedisSession
 
 
@@ -96,6 +98,22 @@ def setup_server():
             return "logged in"
         regen.exposed = True
 
+        def external_write(self):
+            # The session was found when the request started, and another
+            # process changes it before it's locked.
+            sess = cherrypy.session
+            sess.cache.set(sess.prefix + sess.id, sess._encode({'counter': 100}, None))
+            sess.acquire_lock()
+            return str(sess['counter'])
+        external_write.exposed = True
+        external_write._cp_config = {'tools.sessions.locking': 'explicit'}
+
+        def regen_unchanged(self):
+            cherrypy.session.load()
+            cherrypy.tools.sessions.regenerate()
+            return "logged in"
+        regen_unchanged.exposed = True
+
         def length(self):
             return str(len(cherrypy.session))
         length.exposed = True
@@ -112,6 +130,7 @@ def setup_server():
 
     cherrypy.lib.sessions.RedisSession = RedisSession
     cherrypy.tree.mount(Root())
+    cherrypy.tree.mount(PoolStatus(RedisSession.stats_channel), "/pool_status")
 
 # testing that redis-py is available and that we have a redis server running
 try:
@@ -228,3 +247,164 @@ else:
             # code has to survive calling save/close without init.
             self.getPage('/restricted', self.cookies, method='POST')
             self.assertErrorPage(405)
+
+        def _get_session_key(self):
+            session_id = self.cookies[0][1].split(';')[0].split('=')[1]
+            return RedisSession.prefix + session_id
+
+        def test_6_Unchanged_data(self):
+            self.getPage('/testStr')
+            self.assertBody('1')
+            key = self._get_session_key()
+            stored = RedisSession.cache.get(key)
+
+            # Reading the session doesn't write it back...
+            self.getPage('/keyin?key=counter', self.cookies)
+            self.assertBody("True")
+            self.assertEqual(RedisSession.cache.get(key), stored)
+            self.assertTrue(RedisSession.cache.ttl(key) > 0)
+
+            # ...but changing it does.
+            self.getPage('/testStr', self.cookies)
+            self.assertBody('2')
+            self.assertNotEqual(RedisSession.cache.get(key), stored)
+
+        def test_7_Touch_interval(self):
+            self.getPage('/testStr')
+            self.assertBody('1')
+            key = self._get_session_key()
+
+            # Unchanged data has its TTL refreshed...
+            time.sleep(0.25)
+            self.getPage('/keyin?key=counter', self.cookies)
+            self.assertTrue(RedisSession.cache.pttl(key) > 900)
+
+            # ...unless it was refreshed less than `touch_interval` ago.
+            RedisSession.touch_interval = 30
+            try:
+                time.sleep(0.25)
+                self.getPage('/keyin?key=counter', self.cookies)
+                self.assertBody("True")
+                self.assertTrue(RedisSession.cache.pttl(key) < 900)
+            finally:
+                RedisSession.touch_interval = 0
+
+        def test_8_Redis_locking(self):
+            RedisSession.lock_backend = "redis"
+            try:
+                self.test_1_Concurrency()
+                self.assertEqual(RedisSession.cache.keys('*' + RedisSession.LOCK_SUFFIX), [])
+            finally:
+                RedisSession.lock_backend = "local"
+
+        def test_9_Local_locks_are_discarded(self):
+            self.getPage('/testStr')
+            self.getPage('/testStr', self.cookies)
+            self.assertBody('2')
+            session_id = self._get_session_key()[len(RedisSession.prefix):]
+            self.assertFalse(session_id in RedisSession.locks)
+
+        def test_10_Length_is_cached(self):
+            self.getPage('/clear')
+            RedisSession.count_interval = 0
+            try:
+                self.getPage('/testStr')
+                self.getPage('/length', self.cookies)
+                self.assertBody('1')
+
+                RedisSession.count_interval = 60
+                self.getPage('/testStr', [])
+                self.getPage('/length', self.cookies)
+                self.assertBody('1')
+
+                RedisSession.count_interval = 0
+                self.getPage('/length', self.cookies)
+                self.assertBody('2')
+            finally:
+                RedisSession.count_interval = 10
+
+        def test_11_Pool_stats(self):
+            self.getPage('/testStr')
+            stats = RedisSession.pool_stats()
+            self.assertTrue(stats["created"] >= 1)
+            self.assertEqual(stats["in_use"] + stats["idle"], stats["created"])
+
+            self.getPage('/pool_status/')
+            self.assertStatus(200)
+            stats = jsonlib.loads(self.body.decode())
+            self.assertEqual(1, len(stats))
+            self.assertEqual("sessions", stats[0]["name"])
+            self.assertTrue(stats[0]["created"] >= 1)
+
+        def test_12_Codecs(self):
+            self.getPage('/testStr')
+            self.assertBody('1')
+            key = self._get_session_key()
+            self.assertEqual(RedisSession.cache.get(key)[:1], b'\x80')
+
+            try:
+                # Sessions stored by older versions can still be loaded.
+                RedisSession.codec = 'json'
+                self.getPage('/testStr', self.cookies)
+                self.assertBody('2')
+                self.assertEqual(RedisSession.cache.get(key)[:4], b'\x00\x01j-')
+
+                RedisSession.compression = 'zlib'
+                RedisSession.compress_threshold = 0
+                self.getPage('/testStr', self.cookies)
+                self.assertBody('3')
+                self.assertEqual(RedisSession.cache.get(key)[:4], b'\x00\x01jz')
+            finally:
+                RedisSession.codec = 'pickle'
+                RedisSession.compression = None
+                RedisSession.compress_threshold = 1024
+
+            self.getPage('/testStr', self.cookies)
+            self.assertBody('4')
+            self.assertEqual(RedisSession.cache.get(key)[:1], b'\x80')
+
+        def test_13_Load_after_lock(self):
+            self.getPage('/testStr')
+            self.assertBody('1')
+            self.getPage('/external_write', self.cookies)
+            self.assertBody('100')
+            self.getPage('/testStr', self.cookies)
+            self.assertBody('101')
+
+        def test_14_Regenerate_unchanged_data(self):
+            self.getPage('/testStr')
+            self.assertBody('1')
+            old_key = self._get_session_key()
+            for touch_interval in (0, 30):
+                RedisSession.touch_interval = touch_interval
+                try:
+                    self.getPage('/regen_unchanged', self.cookies)
+                    self.assertBody('logged in')
+                finally:
+                    RedisSession.touch_interval = 0
+                key = self._get_session_key()
+                self.assertNotEqual(old_key, key)
+                self.assertIsNone(RedisSession.cache.get(old_key))
+                self.assertTrue(RedisSession.cache.ttl(key) > 0)
+                old_key = key
+            self.getPage('/testStr', self.cookies)
+            self.assertBody('2')
+
+        def test_15_Round_trips(self):
+            self.getPage('/testStr')
+            self.assertBody('1')
+
+            commands = []
+            execute_command = RedisSession.cache.execute_command
+
+            def record(*args, **kwargs):
+                commands.append(args[0])
+                return execute_command(*args, **kwargs)
+
+            RedisSession.cache.execute_command = record
+            try:
+                self.getPage('/testStr', self.cookies)
+                self.assertBody('2')
+            finally:
+                del RedisSession.cache.execute_command
+            self.assertEqual(['GET', 'SETEX'], commands)
@@ -0,0 +1,195 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from jinja2 import DictLoader, Environment
+from jinja2.exceptions import TemplateNotFound
+from jinja2.bccache import FileSystemBytecodeCache
+from jinja2.loaders import ModuleLoader
+from yaml import Loader, load as load_yaml
+
+from blueberrypy.exc import BlueberryPyNotConfiguredError
+from blueberrypy import template_engine
+from blueberrypy.template_engine import (RedisBytecodeCache, compile_templates,
+                                         configure_jinja2, warm_bytecode_cache)
+
+
+templates = {"index.html": u"<h1>{{ title }}</h1>",
+             "mail.txt": u"Hello {{ name }}",
+             "broken.html": u"{% if %}"}
+
+
+class WarmBytecodeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = Environment(loader=DictLoader(templates),
+                               bytecode_cache=FileSystemBytecodeCache(self.directory))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_warm(self):
+        compiled, failed = warm_bytecode_cache(self.env)
+        self.assertEqual(["index.html", "mail.txt"], sorted(compiled))
+        self.assertEqual(["broken.html"], list(failed))
+        self.assertEqual(2, len(os.listdir(self.directory)))
+
+    def test_warm_extensions(self):
+        compiled, failed = warm_bytecode_cache(self.env, extensions=["txt"])
+        self.assertEqual(["mail.txt"], compiled)
+        self.assertEqual({}, failed)
+
+    def test_not_configured(self):
+        self.assertRaises(BlueberryPyNotConfiguredError, warm_bytecode_cache,
+                          Environment(loader=DictLoader(templates)))
+
+    def test_warm_yaml_loader(self):
+        searchpath = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(searchpath, "index.html"), "w") as f:
+                f.write(templates["index.html"])
+            # As in the project templates' app.yml
+            loader = load_yaml("!!python/object:jinja2.loaders.FileSystemLoader "
+                               "{encoding: utf-8, searchpath: [%s]}" % searchpath, Loader=Loader)
+            env = configure_jinja2(loader=loader,
+                                   bytecode_cache=FileSystemBytecodeCache(self.directory))
+            compiled, failed = warm_bytecode_cache(env)
+            self.assertEqual(["index.html"], compiled)
+            self.assertEqual({}, failed)
+        finally:
+            shutil.rmtree(searchpath)
+
+
+class CompileTemplatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = Environment(loader=DictLoader(templates))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        template_engine.jinja2_env = None
+
+    def _test_precompiled(self, target):
+        compiled, failed = compile_templates(target, self.env)
+        self.assertEqual(["index.html", "mail.txt"], sorted(compiled))
+        self.assertEqual(["broken.html"], list(failed))
+
+        env = configure_jinja2(precompiled=target)
+        self.assertEqual(u"<h1>Hi</h1>", env.get_template("index.html").render(title="Hi"))
+        self.assertEqual(u"Hello you", env.get_template("mail.txt").render(name="you"))
+        self.assertRaises(TemplateNotFound, env.get_template, "broken.html")
+
+    def test_directory(self):
+        target = os.path.join(self.directory, "templates")
+        self._test_precompiled(target)
+        self.assertEqual(2, len(os.listdir(target)))
+
+    def test_recompile(self):
+        compile_templates(self.directory, self.env)
+        with open(os.path.join(self.directory, "README"), "w") as f:
+            f.write("Not a template")
+
+        # mail.txt was removed since
+        env = Environment(loader=DictLoader({"index.html": templates["index.html"]}))
+        compiled, failed = compile_templates(self.directory, env)
+        self.assertEqual(["index.html"], compiled)
+        self.assertEqual(["README", ModuleLoader.get_module_filename("index.html")],
+                         sorted(os.listdir(self.directory)))
+
+        env = configure_jinja2(precompiled=self.directory)
+        self.assertRaises(TemplateNotFound, env.get_template, "mail.txt")
+
+    def test_zip(self):
+        self._test_precompiled(os.path.join(self.directory, "templates.zip"))
+
+    def test_fallback(self):
+        compile_templates(self.directory, self.env, extensions=["html"])
+        env = configure_jinja2(precompiled=self.directory,
+                               loader=DictLoader({"mail.txt": u"Bye {{ name }}",
+                                                  "index.html": u"{{ title }}"}))
+        # index.html is loaded from the modules compiled, mail.txt from its source
+        self.assertEqual(u"<h1>Hi</h1>", env.get_template("index.html").render(title="Hi"))
+        self.assertEqual(u"Bye you", env.get_template("mail.txt").render(name="you"))
+
+
+# testing that redis-py is available and that we have a redis server running
+try:
+    import redis
+
+    host, port = '127.0.0.1', 6379
+    for res in socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                  socket.SOCK_STREAM):
+        af, socktype, proto, canonname, sa = res
+        s = None
+        try:
+            s = socket.socket(af, socktype, proto)
+            s.settimeout(1.0)
+            s.connect((host, port))
+            s.close()
+        except socket.error:
+            if s:
+                s.close()
+            raise
+        break
+
+except ImportError:
+
+    class RedisBytecodeCacheTest(unittest.TestCase):
+        def test_nothing(self):
+            self.skipTest("redis-py not available")
+
+except socket.error:
+
+    class RedisBytecodeCacheTest(unittest.TestCase):
+        def test_nothing(self):
+            self.skipTest("redis not reachable")
+
+else:
+    class RedisBytecodeCacheTest(unittest.TestCase):
+
+        def setUp(self):
+            self.bytecode_cache = RedisBytecodeCache(prefix="test:jinja2:", host=host, port=port)
+            self.bytecode_cache.clear()
+
+        def tearDown(self):
+            self.bytecode_cache.clear()
+
+        def _get_env(self, templates):
+            return Environment(loader=DictLoader(templates), bytecode_cache=self.bytecode_cache)
+
+        def test_shared(self):
+            compiled, failed = warm_bytecode_cache(self._get_env(templates))
+            self.assertEqual(2, len(compiled))
+            client = self.bytecode_cache.client
+            self.assertEqual(2, len(list(client.scan_iter(match="test:jinja2:*"))))
+
+            # Another process finds the bytecode of the same templates
+            env = self._get_env(templates)
+            bucket = self.bytecode_cache.get_bucket(env, "index.html", None,
+                                                    templates["index.html"])
+            self.assertIsNotNone(bucket.code)
+            self.assertEqual(u"<h1>Hi</h1>", env.get_template("index.html").render(title="Hi"))
+
+            # but not of a changed template
+            changed = dict(templates, **{"index.html": u"<h2>{{ title }}</h2>"})
+            bucket = self.bytecode_cache.get_bucket(env, "index.html", None,
+                                                    changed["index.html"])
+            self.assertIsNone(bucket.code)
+            self.assertEqual(u"<h2>Hi</h2>",
+                             self._get_env(changed).get_template("index.html").render(title="Hi"))
+
+        def test_timeout(self):
+            self.bytecode_cache.timeout = 60
+            self._get_env(templates).get_template("mail.txt")
+            client = self.bytecode_cache.client
+            key, = client.scan_iter(match="test:jinja2:*")
+            self.assertTrue(0 < client.ttl(key) <= 60)
+
+        def test_redis_errors(self):
+            bytecode_cache = RedisBytecodeCache(host=host, port=1)
+            env = Environment(loader=DictLoader(templates), bytecode_cache=bytecode_cache)
+            self.assertEqual(u"Hello you", env.get_template("mail.txt").render(name="you"))
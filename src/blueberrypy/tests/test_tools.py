@@ -1,4 +1,10 @@
+import glob
+import os
+import pstats
+import shutil
 import sys
+import tempfile
+import time
 import unittest
 
 try:
@@ -7,16 +13,18 @@ except ImportError:
     import json
 
 import cherrypy
-from cherrypy import HTTPError, HTTPRedirect
+from cherrypy import HTTPError, HTTPRedirect, InternalRedirect
 from cherrypy.test import helper
 
-from sqlalchemy import Column, Integer, Unicode, engine_from_config
+from sqlalchemy import Column, Integer, Unicode, engine_from_config, event
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
 
 from testconfig import config as testconfig
 
 from blueberrypy.plugins import SQLAlchemyPlugin
-from blueberrypy.tools import MultiHookPointTool, SQLAlchemySessionTool
+from blueberrypy.tools import (MultiHookPointTool, PhaseTimerTool, PhaseTimingStatus,
+                               ProfilerTool, SQLAlchemySessionTool)
 
 
 def get_config(section_name):
@@ -37,6 +45,18 @@ class Address(Base):
     address = Column(Unicode(128), nullable=False, unique=True)
 
 
+def choose_shard(mapper, instance, clause=None):
+    return "a_to_m" if instance.name < u"n" else "n_to_z"
+
+
+def choose_shards_by_id(query, ident):
+    return ["a_to_m", "n_to_z"]
+
+
+def choose_shards_by_query(query):
+    return ["a_to_m", "n_to_z"]
+
+
 class MultiHookPointToolTest(helper.CPWebCase, unittest.TestCase):
 
     @staticmethod
@@ -92,6 +112,15 @@ class MultiHookPointToolTest(helper.CPWebCase, unittest.TestCase):
                                   "tools.test_multi_hook_point.on_end_resource.param": 13,
                                   "tools.test_multi_hook_point.on_end_request.param": 19}
 
+            @cherrypy.expose
+            def priorities(self):
+                hooks = cherrypy.request.hooks
+                return json.dumps(dict((hook_point, [hook.priority for hook in hooks[hook_point]
+                                                     if hook.callback.__name__ == hook_point])
+                                       for hook_point in ("before_handler", "before_finalize")))
+            priorities._cp_config = {"tools.test_multi_hook_point.priority": 60,
+                                     "tools.test_multi_hook_point.before_finalize.priority": 80}
+
             @cherrypy.expose
             def failure(self):
                 return 1 / 0
@@ -108,16 +137,176 @@ class MultiHookPointToolTest(helper.CPWebCase, unittest.TestCase):
         self.assertHeader("x-on-end-resource", str(13))
         self.assertEqual(MultiHookPointToolTest.on_end_request_param, 19)
 
+    def test_priorities(self):
+        self.getPage("/priorities")
+        self.assertEqual({"before_handler": [60], "before_finalize": [80]},
+                         json.loads(self.body))
+
     def test_failure(self):
         self.getPage("/failure")
         self.assertHeader("x-before-error-response", str(7))
         self.assertHeader("x-after-error-response", str(8))
 
 
+class ProfilerToolTest(helper.CPWebCase, unittest.TestCase):
+
+    directory = tempfile.mkdtemp()
+    rotated_directory = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+
+        super(ProfilerToolTest, cls).teardown_class()
+
+        shutil.rmtree(cls.directory)
+        shutil.rmtree(cls.rotated_directory)
+    tearDownClass = teardown_class
+
+    @staticmethod
+    def setup_server():
+
+        class Root(object):
+
+            _cp_config = {"tools.profiler.on": True,
+                          "tools.profiler.on_start_resource.directory": ProfilerToolTest.directory,
+                          "tools.profiler.on_start_resource.sample_rate": 0,
+                          "tools.profiler.on_start_resource.header": "X-Profile",
+                          "tools.profiler.on_start_resource.secret": "s3cret"}
+
+            @cherrypy.expose
+            def slow(self):
+                time.sleep(0.01)
+                return "OK"
+
+            @cherrypy.expose
+            def rotated(self, n):
+                return n
+            rotated._cp_config = {
+                "tools.profiler.on_start_resource.directory": ProfilerToolTest.rotated_directory,
+                "tools.profiler.on_start_resource.sample_rate": 1,
+                "tools.profiler.on_start_resource.max_profiles": 2}
+
+        cherrypy.tools.profiler = ProfilerTool()
+        cherrypy.tree.mount(Root())
+
+    def _get_profiles(self, directory=None, until=bool):
+        # The profile is saved after the response is sent.
+        for _ in range(20):
+            profiles = glob.glob(os.path.join(directory or self.directory, "*.prof"))
+            if until(profiles):
+                break
+            time.sleep(0.05)
+        return profiles
+
+    def test_profile(self):
+        self.getPage("/slow")
+        self.assertStatus(200)
+        self.getPage("/slow", headers=[("X-Profile", "wrong")])
+        self.assertStatus(200)
+        self.assertEqual([], self._get_profiles())
+
+        self.getPage("/slow", headers=[("X-Profile", "s3cret")])
+        self.assertStatus(200)
+        profiles = self._get_profiles()
+        self.assertEqual(1, len(profiles))
+        self.assertIn("-GET-slow-", os.path.basename(profiles[0]))
+
+        stats = pstats.Stats(profiles[0])
+        self.assertTrue(any(function == "slow" for _, _, function in stats.stats))
+
+    def test_max_profiles(self):
+        profiles = []
+        for n in range(3):
+            self.getPage("/rotated?n=%d" % n)
+            self.assertStatus(200)
+            saved = self._get_profiles(self.rotated_directory,
+                                       lambda found: set(found) - set(profiles) and
+                                       len(found) <= 2)
+            self.assertEqual(1, len(set(saved) - set(profiles)))
+            profiles = saved
+        self.assertEqual(2, len(profiles))
+
+
+class PhaseTimerToolTest(helper.CPWebCase, unittest.TestCase):
+
+    @staticmethod
+    def setup_server():
+
+        class Timed(object):
+
+            _cp_config = {"tools.phase_timer.on": True,
+                          "tools.phase_timer.on_start_resource.server_timing": True}
+
+            @cherrypy.expose
+            def slow(self):
+                time.sleep(0.05)
+                return "OK"
+
+            @cherrypy.expose
+            def fail(self):
+                time.sleep(0.05)
+                raise ValueError
+
+        cherrypy.tools.phase_timer = PhaseTimerTool()
+        cherrypy.tree.mount(Timed(), "/timed")
+        cherrypy.tree.mount(PhaseTimingStatus(cherrypy.tools.phase_timer.timings), "/timings")
+
+    def test_phase_timing(self):
+        cherrypy.tools.phase_timer.timings.clear()
+
+        self.getPage("/timed/slow")
+        self.assertStatus(200)
+        server_timing = dict(phase.split(";dur=")
+                             for phase in self.assertHeader("Server-Timing").split(", "))
+        self.assertGreaterEqual(float(server_timing["handler"]), 50)
+        self.assertIn("before_handler", server_timing)
+        self.assertIn("before_finalize", server_timing)
+        self.assertNotIn("write", server_timing)
+        self.assertNotIn("total", server_timing)
+
+        # The timings are recorded after the response is sent.
+        for _ in range(20):
+            self.getPage("/timings/")
+            timings = json.loads(self.body)
+            if "blueberrypy.tests.test_tools.Timed.slow" in timings:
+                break
+            time.sleep(0.05)
+        slow = timings["blueberrypy.tests.test_tools.Timed.slow"]
+        self.assertEqual(1, slow["handler"]["count"])
+        self.assertGreaterEqual(slow["handler"]["max"], 0.05)
+        self.assertGreaterEqual(slow["total"]["total"], slow["handler"]["total"])
+        self.assertEqual(1, sum(bucket["count"] for bucket in slow["total"]["histogram"]))
+        self.assertIn("write", slow)
+
+    def test_phase_timing_error(self):
+        cherrypy.tools.phase_timer.timings.clear()
+
+        self.getPage("/timed/fail")
+        self.assertStatus(500)
+        server_timing = dict(phase.split(";dur=")
+                             for phase in self.assertHeader("Server-Timing").split(", "))
+        self.assertGreaterEqual(float(server_timing["handler"]), 50)
+        self.assertIn("error_response", server_timing)
+        self.assertNotIn("write", server_timing)
+
+        for _ in range(20):
+            self.getPage("/timings/")
+            timings = json.loads(self.body)
+            if "blueberrypy.tests.test_tools.Timed.fail" in timings:
+                break
+            time.sleep(0.05)
+        fail = timings["blueberrypy.tests.test_tools.Timed.fail"]
+        self.assertEqual(1, fail["error_response"]["count"])
+        self.assertEqual(1, fail["write"]["count"])
+
+
 class SQLAlchemySessionToolSingleEngineTest(helper.CPWebCase, unittest.TestCase):
 
     engine = engine_from_config(get_config('sqlalchemy_engine'), '')
 
+    # The (path, session) of the sessions of each request
+    sessions = []
+
     @classmethod
     def setup_class(cls):
 
@@ -190,8 +379,141 @@ class SQLAlchemySessionToolSingleEngineTest(helper.CPWebCase, unittest.TestCase)
                 return json.dumps({'id': bob.id, 'name': bob.name})
             raise_passable_exception_query.exposed = True
 
+            def session_factory_id(self):
+                return str(id(cherrypy.request.orm_session.registry))
+            session_factory_id.exposed = True
+
+            def unused_session(self):
+                return "OK"
+            unused_session.exposed = True
+
+            def internal_redirect(self):
+                session = cherrypy.request.orm_session
+                session.add(User(name=u"frank"))
+                session.flush()
+                raise InternalRedirect('/count_users', 'name=frank')
+            internal_redirect.exposed = True
+
+            def count_users(self, name):
+                session = cherrypy.request.orm_session
+                return str(session.query(User).filter_by(name=name).count())
+            count_users.exposed = True
+
+            def autocommit_save(self):
+                session = cherrypy.request.orm_session
+                carol = User(name=u"carol")
+                session.add(carol)
+                return carol
+            autocommit_save.exposed = True
+            autocommit_save._cp_config = {
+                'tools.orm_session.on_start_resource.transaction': 'commit',
+                'tools.checked_out_after_handler.on': True,
+                'tools.user_json_out.on': True}
+
+            def autocommit_redirect(self):
+                session = cherrypy.request.orm_session
+                session.add(User(name=u"dave"))
+                raise HTTPRedirect('/')
+            autocommit_redirect.exposed = True
+            autocommit_redirect._cp_config = {
+                'tools.orm_session.on_start_resource.transaction': 'commit'}
+
+            def autocommit_failure(self):
+                session = cherrypy.request.orm_session
+                session.add(User(name=u"erin"))
+                raise ValueError
+            autocommit_failure.exposed = True
+            autocommit_failure._cp_config = {
+                'tools.orm_session.on_start_resource.transaction': 'commit'}
+
+            def readonly_query(self):
+                session = cherrypy.request.orm_session
+                return session.query(User).filter_by(name=u"carol").one()
+            readonly_query.exposed = True
+            readonly_query._cp_config = {
+                'tools.orm_session.on_start_resource.transaction': 'readonly',
+                'tools.checked_out_after_handler.on': True,
+                'tools.user_json_out.on': True}
+
+            def readonly_query_priority(self):
+                return self.readonly_query()
+            readonly_query_priority.exposed = True
+            readonly_query_priority._cp_config = dict(readonly_query._cp_config, **{
+                'tools.orm_session.priority': 60})
+
+            def autocommit_generator(self, name):
+                session = cherrypy.request.orm_session
+
+                def body():
+                    session.add(User(name=name))
+                    session.flush()
+                    yield str(session.query(User).filter_by(name=name).count())
+                return body()
+            autocommit_generator.exposed = True
+            autocommit_generator._cp_config = {
+                'tools.orm_session.on_start_resource.transaction': 'commit'}
+
+            def autocommit_stream(self, name):
+                return self.autocommit_generator(name)
+            autocommit_stream.exposed = True
+            autocommit_stream._cp_config = {
+                'tools.orm_session.on_start_resource.transaction': 'commit',
+                'response.stream': True}
+
+            def unused_session_error(self):
+                raise ValueError
+            unused_session_error.exposed = True
+
+            def timed_queries(self):
+                session = cherrypy.request.orm_session
+                session.query(User).all()
+                session.query(Address).all()
+                stats = cherrypy.request.orm_query_stats
+                return json.dumps({'count': stats.count,
+                                   'total': stats.total,
+                                   'max': stats.max})
+            timed_queries.exposed = True
+            timed_queries._cp_config = {
+                'tools.orm_session.on_start_resource.slow_query_threshold': 0,
+                'tools.orm_session.on_start_resource.server_timing': True,
+                'tools.phase_timer.on': True,
+                'tools.phase_timer.on_start_resource.server_timing': True}
+
+        def checked_out_after_handler():
+            req = cherrypy.request
+            inner_handler = req.handler
+
+            def handler(*args, **kwargs):
+                body = inner_handler(*args, **kwargs)
+                checked_out = cherrypy.engine.sqlalchemy.pool_metrics[0].checked_out
+                cherrypy.response.headers['X-Checked-Out'] = str(checked_out)
+                return body
+            req.handler = handler
+
+        def user_json_out():
+            req = cherrypy.request
+            inner_handler = req.handler
+
+            def handler(*args, **kwargs):
+                user = inner_handler(*args, **kwargs)
+                return json.dumps({'id': user.id, 'name': user.name})
+            req.handler = handler
+
+        def record_session(session, transaction):
+            if transaction.parent is None:
+                SQLAlchemySessionToolSingleEngineTest.sessions.append(
+                    (cherrypy.request.path_info, session))
+
+        event.listen(Session, "after_transaction_create", record_session)
+
         cherrypy.engine.sqlalchemy = SQLAlchemyPlugin(cherrypy.engine, testconfig)
         cherrypy.tools.orm_session = SQLAlchemySessionTool()
+        cherrypy.tools.phase_timer = PhaseTimerTool()
+        cherrypy.tools.checked_out_after_handler = cherrypy.Tool('before_handler',
+                                                                 checked_out_after_handler,
+                                                                 priority=30)
+        cherrypy.tools.user_json_out = cherrypy.Tool('before_handler', user_json_out,
+                                                     priority=40)
         cherrypy.config.update({'engine.sqlalchemy.on': True})
         cherrypy.tree.mount(SingleEngine())
 
@@ -232,6 +554,100 @@ class SQLAlchemySessionToolSingleEngineTest(helper.CPWebCase, unittest.TestCase)
         self.assertEqual(u'bob', json_resp['name'])
         self.assertStatus(200)
 
+    def test_internal_redirect(self):
+        # The redirected request runs on the same thread, but doesn't get the
+        # session of the request it was redirected from.
+        self.getPage('/internal_redirect')
+        self.assertStatus(200)
+        self.assertBody('0')
+
+    def test_session_factory_reused(self):
+        self.getPage('/session_factory_id')
+        session_factory_id = self.body
+        self.getPage('/session_factory_id')
+        self.assertBody(session_factory_id)
+
+    def test_transaction_commit(self):
+        self.getPage('/autocommit_save')
+        self.assertStatus(200)
+        self.assertHeader('X-Checked-Out', '0')
+        self.assertEqual(u'carol', json.loads(self.body)['name'])
+        self.getPage('/count_users?name=carol')
+        self.assertBody('1')
+
+        self.getPage('/autocommit_redirect')
+        self.assertStatus(303)
+        self.getPage('/count_users?name=dave')
+        self.assertBody('1')
+
+        del self.sessions[:]
+        self.getPage('/autocommit_failure')
+        self.assertStatus(500)
+        # The session removed when the handler failed isn't set up again to
+        # be rolled back
+        self.assertEqual(1, len(set(session for path, session in self.sessions
+                                    if path == '/autocommit_failure')))
+        self.getPage('/count_users?name=erin')
+        self.assertBody('0')
+
+    def test_transaction_readonly(self):
+        self.getPage('/autocommit_save')
+        self.getPage('/readonly_query')
+        self.assertStatus(200)
+        self.assertHeader('X-Checked-Out', '0')
+        self.assertEqual(u'carol', json.loads(self.body)['name'])
+
+        # The tool-wide priority doesn't move the handler wrapper
+        self.getPage('/readonly_query_priority')
+        self.assertStatus(200)
+        self.assertHeader('X-Checked-Out', '0')
+
+    def test_transaction_generator(self):
+        for path, name in (('/autocommit_generator', u'grace'),
+                           ('/autocommit_stream', u'heidi')):
+            self.getPage('%s?name=%s' % (path, name))
+            self.assertStatus(200)
+            self.assertBody('1')
+            self.getPage('/count_users?name=%s' % name)
+            self.assertBody('1')
+
+            # The streamed body's connection is returned after it's written.
+            metrics = cherrypy.engine.sqlalchemy.pool_metrics[0]
+            for _ in range(20):
+                if metrics.checked_out == 0:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(0, metrics.checked_out)
+
+    def test_unused_session(self):
+        tool = cherrypy.tools.orm_session
+        factories = dict(tool._session_factories)
+        tool._session_factories.clear()
+        try:
+            self.getPage('/unused_session')
+            self.assertStatus(200)
+            self.assertEqual({}, tool._session_factories)
+            self.getPage('/unused_session_error')
+            self.assertStatus(500)
+            self.assertEqual({}, tool._session_factories)
+        finally:
+            tool._session_factories.update(factories)
+
+    def test_query_timing(self):
+        self.getPage('/timed_queries')
+        self.assertStatus(200)
+        json_resp = json.loads(self.body)
+        self.assertEqual(2, json_resp['count'])
+        self.assertGreaterEqual(json_resp['total'], json_resp['max'])
+        self.assertGreater(json_resp['max'], 0)
+        # Along with the phases timed by the phase_timer tool
+        server_timing = self.assertHeader('Server-Timing')
+        self.assertIn('2 queries', server_timing)
+        self.assertIn('handler;dur=', server_timing)
+
+        self.getPage('/query_user')
+        self.assertNoHeader('Server-Timing')
+
 
 class SQLAlchemySessionToolTwoPhaseTest(helper.CPWebCase, unittest.TestCase):
 
@@ -365,3 +781,149 @@ class SQLAlchemySessionToolTwoPhaseTest(helper.CPWebCase, unittest.TestCase):
         self.assertIn('name', json_resp)
         self.assertEqual(u'david', json_resp['name'])
         self.assertStatus(200)
+
+
+class SQLAlchemySessionToolCommitStrategyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prepared = []
+        self.engine_bindings = {}
+        for model in (User, Address):
+            engine = engine_from_config({"url": "sqlite://"}, '')
+            model.__table__.create(engine)
+            self._fake_twophase(engine)
+            self.engine_bindings[model] = engine
+
+        self.sqlalchemy_plugin = getattr(cherrypy.engine, "sqlalchemy", None)
+        cherrypy.engine.sqlalchemy = SQLAlchemyPlugin(cherrypy.engine, {})
+        cherrypy.engine.sqlalchemy.engine_bindings = self.engine_bindings
+
+    def tearDown(self):
+        cherrypy.engine.sqlalchemy = self.sqlalchemy_plugin
+
+    def _fake_twophase(self, engine):
+        # SQLite doesn't support two-phase commit, make it look like it does.
+        dialect = engine.dialect
+        dialect.do_begin_twophase = lambda conn, xid: dialect.do_begin(conn.connection)
+        dialect.do_prepare_twophase = lambda conn, xid: self.prepared.append(engine)
+
+        def do_commit_twophase(conn, xid, is_prepared=True, recover=False):
+            dialect.do_commit(conn.connection)
+        dialect.do_commit_twophase = do_commit_twophase
+
+    def _commit(self, commit_strategy, *instances):
+        tool = SQLAlchemySessionTool()
+        Session = tool._get_session_factory([User, Address], commit_strategy)
+        try:
+            Session.add_all(instances)
+            Session.commit()
+        finally:
+            Session.remove()
+
+    def test_auto_one_database(self):
+        self._commit("auto", User(name=u"alice"))
+        self._commit("auto", Address(address=u"Hong Kong"))
+        self.assertEqual(self.prepared, [])
+
+    def test_auto_read_one_database(self):
+        self._commit("auto", Address(address=u"Hong Kong"))
+        tool = SQLAlchemySessionTool()
+        Session = tool._get_session_factory([User, Address], "auto")
+        try:
+            self.assertEqual(1, Session.query(Address).count())
+            Session.add(User(name=u"alice"))
+            Session.commit()
+        finally:
+            Session.remove()
+        self.assertEqual(self.prepared, [])
+
+    def test_auto_several_databases(self):
+        self._commit("auto", User(name=u"alice"), Address(address=u"Hong Kong"))
+        self.assertEqual(len(self.prepared), 2)
+
+    def test_twophase(self):
+        self._commit("twophase", User(name=u"alice"))
+        self.assertEqual(len(self.prepared), 1)
+
+    def test_sequential(self):
+        self._commit("sequential", User(name=u"alice"), Address(address=u"Hong Kong"))
+        self.assertEqual(self.prepared, [])
+        self.assertEqual(self.engine_bindings[Address].scalar("select count(*) from address"), 1)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, SQLAlchemySessionTool()._get_session_factory,
+                          [User], "whatever")
+
+
+class SQLAlchemySessionToolReplicaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sqlalchemy_plugin = getattr(cherrypy.engine, "sqlalchemy", None)
+        config = {"sqlalchemy_engine": {"url": "sqlite://",
+                                        "replicas": ["sqlite://", "sqlite://"]}}
+        cherrypy.engine.sqlalchemy = plugin = SQLAlchemyPlugin(cherrypy.engine, config)
+        plugin._configure_engines()
+
+        User.__table__.create(plugin.engine)
+        plugin.engine.execute(User.__table__.insert(), name=u"primary")
+        for i, replica in enumerate(plugin.replicas[plugin.engine].engines):
+            User.__table__.create(replica)
+            replica.execute(User.__table__.insert(), name=u"replica %d" % i)
+
+        self.Session = SQLAlchemySessionTool()._get_session_factory(None)
+
+    def tearDown(self):
+        self.Session.remove()
+        cherrypy.engine.sqlalchemy.stop()
+        cherrypy.engine.sqlalchemy = self.sqlalchemy_plugin
+
+    def _query_names(self):
+        return [user.name for user in self.Session.query(User).order_by(User.id)]
+
+    def test_reads_from_replicas(self):
+        self.assertEqual(self._query_names(), [u"replica 0"])
+        self.assertEqual(self._query_names(), [u"replica 0"])
+        self.Session.remove()
+        self.assertEqual(self._query_names(), [u"replica 1"])
+
+    def test_reads_from_primary_after_write(self):
+        self.Session.add(User(name=u"new"))
+        self.Session.flush()
+        self.assertEqual(self._query_names(), [u"primary", u"new"])
+        self.Session.commit()
+        self.assertEqual(self._query_names(), [u"primary", u"new"])
+
+
+class SQLAlchemySessionToolShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sqlalchemy_plugin = getattr(cherrypy.engine, "sqlalchemy", None)
+        config = {"sqlalchemy_engine": {
+            "shards": {"a_to_m": "sqlite://", "n_to_z": {"url": "sqlite://"}},
+            "shard_chooser": "blueberrypy.tests.test_tools.choose_shard",
+            "id_chooser": "blueberrypy.tests.test_tools.choose_shards_by_id",
+            "query_chooser": "blueberrypy.tests.test_tools.choose_shards_by_query"}}
+        cherrypy.engine.sqlalchemy = plugin = SQLAlchemyPlugin(cherrypy.engine, config)
+        plugin._configure_engines()
+
+        for engine in plugin.shards.viewvalues():
+            User.__table__.create(engine)
+
+        self.Session = SQLAlchemySessionTool()._get_session_factory(None)
+
+    def tearDown(self):
+        self.Session.remove()
+        cherrypy.engine.sqlalchemy.stop()
+        cherrypy.engine.sqlalchemy = self.sqlalchemy_plugin
+
+    def test_sharded_session(self):
+        self.assertFalse(hasattr(cherrypy.engine.sqlalchemy, "engine"))
+
+        self.Session.add_all([User(name=u"alice"), User(name=u"zoe")])
+        self.Session.commit()
+
+        shards = cherrypy.engine.sqlalchemy.shards
+        self.assertEqual(shards["a_to_m"].scalar("select name from user"), u"alice")
+        self.assertEqual(shards["n_to_z"].scalar("select name from user"), u"zoe")
+        self.assertEqual(sorted(user.name for user in self.Session.query(User)),
+                         [u"alice", u"zoe"])
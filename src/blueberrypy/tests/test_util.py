@@ -11,10 +11,11 @@ from geoalchemy2 import Geometry
 from geoalchemy2.shape import to_shape
 from shapely.geometry import Point
 from sqlalchemy import (Column, Integer, Date, DateTime, Time, Interval, Enum,
-                        ForeignKey, UnicodeText, engine_from_config)
+                        ForeignKey, UnicodeText, engine_from_config, event)
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 
+from blueberrypy import util
 from blueberrypy.util import (CSRFToken, pad_block_cipher_message,
                               unpad_block_cipher_message,
                               from_collection, to_collection)
@@ -149,6 +150,51 @@ class CollectionUtilTest(unittest.TestCase):
         session.close()
         metadata.drop_all(engine)
 
+    def test_from_collection_batches_relationship_loading(self):
+        session = sessionmaker(engine)()
+        te = session.query(TestEntity).get(2)
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            doc = {'related': [{'id': 3, 'key': u'key3'}, {'id': 4, 'key': u'key4'}]}
+            te = from_collection(doc, te)
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual([3, 4], sorted([related.id for related in te.related]))
+        self.assertEqual([u'key3', u'key4'], sorted([related.key for related in te.related]))
+        selects = [s for s in statements if s.startswith("SELECT")]
+        self.assertEqual(1, len([s for s in selects if "related.id IN" in s]))
+        self.assertEqual(0, len([s for s in selects if "related.id =" in s]))
+        session.rollback()
+        session.close()
+
+    def test_from_collection_skips_excluded_relationships(self):
+        session = sessionmaker(engine)()
+        te = session.query(TestEntity).get(2)
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            doc = {'related': [{'id': 3, 'key': u'key3'}, {'id': 4, 'key': u'key4'}]}
+            te = from_collection(doc, te, excludes=["related"])
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual([u'related3', u'related4'], sorted([related.key for related in te.related]))
+        self.assertEqual(0, len([s for s in statements if "related.id IN" in s]))
+        session.rollback()
+        session.close()
+
     def test_to_collection(self):
         self.assertEqual(1, to_collection(1))
         self.assertEqual(1.1, to_collection(1.1))
@@ -229,6 +275,57 @@ class CollectionUtilTest(unittest.TestCase):
         serialized_doc = '[{"combined": {"datetime": "2012-01-01T00:00:00"}, "date": {"date": "2012-01-01"}, "datetime": {"datetime": "2012-01-01T00:00:00"}, "discriminator": "derived", "geo": {"coordinates": [45.0, 45.0], "type": "Point"}, "related": [{"discriminator": "related", "id": 1, "key": "related1", "parent_id": 1}, {"discriminator": "relatedsubclass", "id": 2, "key": "related2", "parent_id": 1, "subclass_prop": "sub1"}], "time": {"time": "00:00:00"}}, {"date": {"date": "2013-02-02"}, "datetime": {"datetime": "2013-02-02T01:01:01"}, "discriminator": "base", "geo": {"coordinates": [46.0, 44.0], "type": "Point"}, "id": 2, "interval": {"interval": 3601}, "related": [{"discriminator": "related", "id": 3, "key": "related3", "parent_id": 2}, {"discriminator": "related", "id": 4, "key": "related4", "parent_id": 2}], "time": {"time": "01:01:01"}}]'
         self.assertEqual(serialized_doc, result)
 
+    def test_to_collection_reuses_plans(self):
+        session = Session()
+        tes = session.query(TestEntity).order_by(TestEntity.id).all()
+
+        first = to_collection(tes, recursive=True, excludes=["geo"])
+        self.assertEqual(first, to_collection(tes, recursive=True, excludes=["geo"]))
+        self.assertEqual(first, to_collection(tes, recursive=True, excludes=("geo",)))
+        self.assertNotIn("geo", first[0])
+        self.assertNotIn("parent", first[0]["related"][0])
+
+        # a different set of excludes must not reuse the cached plan
+        second = to_collection(tes, recursive=True, excludes=["id"])
+        self.assertIn("geo", second[0])
+        self.assertNotIn("id", second[0])
+        self.assertIn("id", second[0]["related"][0])
+
+    def test_to_collection_plan_cache_size(self):
+        session = Session()
+        te = session.query(TestEntity).get(2)
+
+        old_cache_size = util.SERIALIZATION_PLAN_CACHE_SIZE
+        util.SERIALIZATION_PLAN_CACHE_SIZE = 4
+        try:
+            fields = ["id", "date", "time", "datetime", "interval", "geo"]
+            for i in range(len(fields)):
+                result = to_collection(te, excludes=fields[:i + 1])
+                self.assertNotIn(fields[i], result)
+                self.assertTrue(len(util._serialization_plans) <= 4)
+
+            # the most recently used plans are kept
+            plan = util._serialization_plans.values()[-1]
+            to_collection(te, excludes=fields)
+            self.assertIs(plan, util._serialization_plans.values()[-1])
+        finally:
+            util.SERIALIZATION_PLAN_CACHE_SIZE = old_cache_size
+
+    def test_to_collection_stream(self):
+        session = Session()
+        query = session.query(TestEntity).order_by(TestEntity.id)
+
+        chunks = to_collection(query, recursive=True, format="json", stream=True, sort_keys=True)
+        self.assertFalse(isinstance(chunks, (str, basestring)))
+        self.assertEqual(to_collection(query, recursive=True, format="json", sort_keys=True),
+                         "".join(chunks))
+
+        te = query.first()
+        self.assertEqual(to_collection(te, format="json", sort_keys=True),
+                         "".join(to_collection(te, format="json", stream=True, sort_keys=True)))
+        self.assertEqual("[]", "".join(to_collection([], format="json", stream=True)))
+        self.assertRaises(ValueError, to_collection, query, stream=True)
+
     def test_from_collection(self):
         self.assertEqual(1, from_collection(1, None))
         self.assertEqual(1.1, from_collection(1.1, None))
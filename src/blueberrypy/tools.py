@@ -1,14 +1,31 @@
+import collections
+import cProfile
+import functools
+import hmac
 import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
 import warnings
 
 import cherrypy
 from cherrypy._cptools import Tool, _getargs
 
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session as SessionBase, scoped_session, sessionmaker
+from sqlalchemy.sql import Select
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.horizontal_shard import ShardedSession
 
+from blueberrypy.plugins import Histogram, JSONStatus
 
-__all__ = ["SQLAlchemySessionTool"]
+
+__all__ = ["SQLAlchemySessionTool", "QueryStats", "ProfilerTool", "PhaseTimerTool",
+           "PhaseTimings", "PhaseTimingStatus"]
 
 
 logger = logging.getLogger(__name__)
@@ -38,6 +55,10 @@ class MultiHookPointTool(Tool):
         The only difference is all the tool arguments are prefixed with their
         hook point names to avoid name conflicts.
 
+        The `priority` option sets the default priority of all the hooks,
+        except those with a true `fixed_priority` attribute, which only the
+        `<hook point>.priority` option changes.
+
         Example::
 
             app_config = {
@@ -53,9 +74,15 @@ class MultiHookPointTool(Tool):
         self._setargs()
 
     def _setargs(self):
+        # The hooks are looked up once, so setting them up for a request
+        # only has to sort the config out.
+        self._hooks = []
         for hook_point in cherrypy._cprequest.hookpoints:
             if hasattr(self, hook_point):
                 hook = getattr(self, hook_point)
+                if not callable(hook):
+                    warnings.warn("%r is not a callable." % hook)
+                self._hooks.append((hook_point, hook))
                 try:
                     for arg in _getargs(hook):
                         setattr(self, hook_point + "_" + arg, None)
@@ -74,82 +101,696 @@ class MultiHookPointTool(Tool):
         request = cherrypy.request
 
         conf = self._merged_args()
+        default_priority = conf.pop("priority", None)
+
+        hook_confs = {}
+        for k, v in conf.items():
+            hook_point, _, arg = k.partition(".")
+            if arg:
+                hook_confs.setdefault(hook_point, {})[arg] = v
+
+        for hook_point, hook in self._hooks:
+            hook_conf = hook_confs.get(hook_point, {})
+            hook_priority = hook_conf.pop("priority", None)
+            if hook_priority is None and not getattr(hook, "fixed_priority", False):
+                hook_priority = default_priority
+            if hook_priority is None:
+                hook_priority = getattr(hook, "priority", self._priority)
+            request.hooks.attach(hook_point, hook, priority=hook_priority, **hook_conf)
 
-        for hook_point in cherrypy._cprequest.hookpoints:
+    def __call__(self, *args, **kwargs):
+        raise NotImplementedError("This %r instance cannot be called directly." %
+                                  self.__class__.__name__)
 
-            if hasattr(self, hook_point):
-                hook = getattr(self, hook_point)
-                if not callable(hook):
-                    warnings.warn("%r is not a callable." % hook)
 
-                hook_conf = {}
-                for k, v in conf.viewitems():
-                    if k.startswith(hook_point):
-                        k = k.replace(hook_point, "").split(".", 1)[-1]
-                        hook_conf[k] = v
+class _WriteTrackingSession(SessionBase):
+    """A session that keeps track of the engines it writes to.
 
-                priority_key = hook_point + ".priority"
-                hook_priority = (self._priority
-                                 if priority_key not in hook_conf
-                                 else hook_conf[priority_key])
-                request.hooks.attach(hook_point, hook, hook_priority, **hook_conf)
+    Every statement but SELECTs, including the ones run by `execute()`, and
+    every statement run by a flush counts as a write.
+    """
 
-    def __call__(self, *args, **kwargs):
-        raise NotImplementedError("This %r instance cannot be called directly." %
-                                  self.__class__.__name__)
+    def __init__(self, **kwargs):
+        SessionBase.__init__(self, **kwargs)
+        self.written_binds = set()
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        bind = SessionBase.get_bind(self, mapper, clause, **kwargs)
+        if getattr(self, "_flushing", True) or not isinstance(clause, Select):
+            self.written_binds.add(bind)
+        return bind
+
+
+def _skip_prepare_if_not_needed(session):
+    # Which databases a unit of work writes to is only known once it's flushed.
+    session.flush()
+    session.twophase = len(session.written_binds) > 1
+
+
+def _restore_twophase(session, transaction):
+    if transaction.parent is None:
+        session.twophase = True
+        session.written_binds.clear()
+
+
+class ReplicaRoutingSession(SessionBase):
+    """A session that runs SELECTs on a read replica of the engine they would
+    otherwise run on, if it has any.
+
+    `replicas` maps engines to their `blueberrypy.plugins.ReplicaSet`. One
+    replica is chosen per engine for the lifetime of the session. Flushes and
+    every other statement run on the primary engine, and so do all the
+    statements after that on the same engine, so the session always reads
+    its own writes.
+    """
+
+    def __init__(self, replicas=None, **kwargs):
+        SessionBase.__init__(self, **kwargs)
+        self.replicas = replicas or {}
+        self._chosen_replicas = {}
+        self._written_engines = set()
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        engine = SessionBase.get_bind(self, mapper, clause, **kwargs)
+        if engine not in self.replicas:
+            return engine
+
+        is_read = (not self._flushing and isinstance(clause, Select) and
+                   getattr(clause, "_for_update_arg", None) is None)
+        if not is_read:
+            self._written_engines.add(engine)
+        if engine in self._written_engines:
+            return engine
+
+        replica = self._chosen_replicas.get(engine)
+        if replica is None:
+            replica = self._chosen_replicas[engine] = self.replicas[engine].choose()
+        return replica
+
+
+class QueryStats(object):
+    """The number of SQL statements a request ran, and how long they took.
+
+    `total` and `max` are in seconds. Statements that take `slow_threshold`
+    seconds or longer are logged, along with `path`.
+    """
+
+    def __init__(self, path, slow_threshold=None):
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, statement, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            logger.warning("Slow query (%.3fs) in %s: %s", elapsed, self.path, statement)
+
+    def server_timing(self):
+        """Return the stats as the value of a Server-Timing header."""
+        return 'db;dur=%.3f;desc="%d queries, max %.3fms"' % (self.total * 1000, self.count,
+                                                              self.max * 1000)
+
+
+def _add_server_timing(value):
+    # Other tools may send their own metrics in the header.
+    headers = cherrypy.response.headers
+    current = headers.get("Server-Timing")
+    headers["Server-Timing"] = "%s, %s" % (current, value) if current else value
+
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if getattr(cherrypy.serving.request, "orm_query_stats", None) is not None:
+        conn.info["orm_query_start_time"] = time.time()
+
+
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("orm_query_start_time", None)
+    stats = getattr(cherrypy.serving.request, "orm_query_stats", None)
+    if start is not None and stats is not None:
+        stats.add(statement, time.time() - start)
+
+
+def _install_query_timers():
+    # Listening on Engine catches the statements of every engine, including
+    # the ones replacing them on graceful. The listeners are only installed
+    # once a request asks for timing, so they cost nothing otherwise.
+    if not event.contains(Engine, "before_cursor_execute", _start_query_timer):
+        event.listen(Engine, "before_cursor_execute", _start_query_timer)
+        event.listen(Engine, "after_cursor_execute", _stop_query_timer)
+
+
+class _LazyScopedSession(object):
+    """Stands in for the scoped session of a request, and only looks it up
+    when it's first used.
+    """
+
+    __slots__ = ("_get_factory", "_factory")
+
+    def __init__(self, get_factory):
+        self._get_factory = get_factory
+        self._factory = None
+
+    def _resolve(self):
+        if self._factory is None:
+            self._factory = self._get_factory()
+        return self._factory
+
+    def __call__(self, **kwargs):
+        return self._resolve()(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+def _end_transaction(session, commit):
+    if session._factory is None:
+        return
+    try:
+        if commit:
+            session().expire_on_commit = False
+            session.commit()
+    finally:
+        session.remove()
+        # Nothing's left to roll back if the request fails later on
+        cherrypy.request.orm_transaction_ended = True
+
+
+def _end_transaction_after(body, session, commit):
+    # Ends the transaction once a streamed or lazily generated body, which
+    # may still run queries, is exhausted or closed.
+    succeeded = False
+    try:
+        for chunk in body:
+            yield chunk
+        succeeded = True
+    finally:
+        _end_transaction(session, commit and succeeded)
+
+
+def _sessionmaker(replicas):
+    if replicas:
+        return sessionmaker(class_=ReplicaRoutingSession, replicas=replicas)
+    return sessionmaker()
 
 
 class SQLAlchemySessionTool(MultiHookPointTool):
     """A CherryPy tool to process SQLAlchemy ORM sessions for requests.
 
     This tools sets up a scoped, possibly multi-engine SQLAlchemy ORM session to
-    `cherrypy.request.orm_session` at the beginning of a request. This tool does
-    not commit changes for you automatically, you must do you explicitly inside
-    your controller code. At the end of each requests, this tool will rollback
-    if errors occured. The session is guaranteed to be removed from the request
-    in the end.
-
-    As this tool hooks up _3_ callables to the request, this tools will also
-    accept 3 `priority` options - `on_start_resource.priority`,
-    `before_finalize.priority` and `after_error_response.priority`. The `priority`
-    option is still accepted as a default for all 3 hook points.
+    `cherrypy.request.orm_session` at the beginning of a request. By default,
+    this tool does not commit changes for you automatically, you must do you
+    explicitly inside your controller code. At the end of each requests, this
+    tool will rollback if errors occured. The session is guaranteed to be
+    removed from the request in the end, at `on_end_request` at the latest,
+    even if the request ends with an `InternalRedirect`.
+
+    The `on_start_resource.transaction` option changes when the session's
+    transaction ends:
+
+    - "explicit": the controller commits, and the session is removed once the
+      response is finalized. This is the default.
+    - "commit": the session is committed as soon as the handler returns, or
+      raises an `HTTPRedirect`, and removed right after. The objects it loaded
+      are not expired by the commit, so they can still be rendered.
+    - "readonly": the session is removed, rolling back its transaction, as
+      soon as the handler returns.
+
+    Both "commit" and "readonly" return the connections to the pool before
+    any output the handler returns is encoded or rendered by the tools
+    wrapping it, such as `json_out`. If the handler returns an iterator
+    instead, such as a generator or `to_collection(..., stream=True)`, the
+    transaction only ends once it's exhausted, or closed. The handler is
+    wrapped at priority 20, before the other tools wrap it, and the
+    `priority` option doesn't change it, only `before_handler.priority`.
+
+    As this tool hooks up _5_ callables to the request, this tools will also
+    accept 5 `priority` options - `on_start_resource.priority`,
+    `before_handler.priority`, `before_finalize.priority`,
+    `after_error_response.priority` and `on_end_request.priority`. The
+    `priority` option is still accepted as a default for all 5 hook points.
+
+    One scoped session factory is created for each distinct `bindings` option
+    the first time it's used, and reused by all the requests after that until
+    the engines it's bound to are replaced.
+
+    When more than one binding is given, the `on_start_resource.commit_strategy`
+    option decides how the session commits to several databases:
+
+    - "twophase": always use two-phase commit.
+    - "sequential": commit each database in turn, without two-phase commit.
+      If one of the commits fails, the ones before it are not rolled back.
+    - "auto": begin two-phase transactions, but only prepare them if the unit
+      of work being committed wrote to more than one database. On databases
+      where a two-phase transaction begins like any other, such as
+      PostgreSQL, this saves the PREPARE round trips. This is the default.
+
+    If the engines have read replicas configured, sessions that don't use
+    two-phase commit run their SELECTs on them, see `ReplicaRoutingSession`.
+    Two-phase sessions always use the primary engines, since read replicas
+    usually can't prepare transactions.
+
+    If the plugin has shards configured, and no `bindings` option is given,
+    the session is a `sqlalchemy.ext.horizontal_shard.ShardedSession` spanning
+    all the shards.
+
+    If the `on_start_resource.query_timing` option is True, the statements run
+    during the request are counted and timed in a `QueryStats` at
+    `cherrypy.request.orm_query_stats`. Statements taking longer than the
+    `on_start_resource.slow_query_threshold` option, in seconds, are logged
+    with the request path. If `on_start_resource.server_timing` is True, the
+    totals are also sent in a Server-Timing response header, which is meant
+    for development. Both options turn timing on by themselves.
+
+    `cherrypy.request.orm_session` is a proxy to the scoped session, which is
+    only set up the first time it's used, so requests that never touch the
+    database don't pay for it, nor for cleaning it up.
     """
 
-    def on_start_resource(self, bindings=None):
+    def __init__(self, name=None, priority=50):
+        MultiHookPointTool.__init__(self, name, priority)
+        self._session_factories = {}
+
+    commit_strategies = ("twophase", "sequential", "auto")
+
+    transaction_modes = ("explicit", "commit", "readonly")
+
+    def _get_session_factory(self, bindings, commit_strategy="auto"):
+        if commit_strategy not in self.commit_strategies:
+            raise ValueError("Unknown commit strategy %r." % commit_strategy)
+
+        sqlalchemy_plugin = cherrypy.engine.sqlalchemy
+        shards = getattr(sqlalchemy_plugin, "shards", None)
+        if bindings:
+            engines = sqlalchemy_plugin.engine_bindings
+        elif shards:
+            engines = shards
+        else:
+            engines = sqlalchemy_plugin.engine
+        replicas = getattr(sqlalchemy_plugin, "replicas", None)
+        key = (tuple(bindings), commit_strategy) if bindings else None
+
+        cached = self._session_factories.get(key)
+        if cached is not None and cached[0] is engines:
+            return cached[1]
+
         if bindings:
 
-            if len(bindings) > 1:
+            if len(bindings) > 1 and commit_strategy == "twophase":
                 Session = scoped_session(sessionmaker(twophase=True))
+            elif len(bindings) > 1 and commit_strategy == "auto":
+                maker = sessionmaker(class_=_WriteTrackingSession, twophase=True)
+                event.listen(maker, "before_commit", _skip_prepare_if_not_needed)
+                event.listen(maker, "after_transaction_end", _restore_twophase)
+                Session = scoped_session(maker)
             else:
-                Session = scoped_session(sessionmaker())
+                Session = scoped_session(_sessionmaker(replicas))
 
             session_bindings = {}
-            engine_bindings = cherrypy.engine.sqlalchemy.engine_bindings
             for binding in bindings:
-                session_bindings[binding] = engine_bindings[binding]
+                session_bindings[binding] = engines[binding]
 
             Session.configure(binds=session_bindings)
 
+        elif shards:
+            Session = scoped_session(sessionmaker(class_=ShardedSession, shards=shards,
+                                                  **sqlalchemy_plugin.shard_choosers))
+
         else:
-            Session = scoped_session(sessionmaker())
-            Session.configure(bind=cherrypy.engine.sqlalchemy.engine)
+            Session = scoped_session(_sessionmaker(replicas))
+            Session.configure(bind=engines)
+
+        self._session_factories[key] = (engines, Session)
+        return Session
 
-        cherrypy.request.orm_session = Session
+    def on_start_resource(self, bindings=None, commit_strategy="auto", transaction="explicit",
+                          query_timing=False, slow_query_threshold=None, server_timing=False):
+        if transaction not in self.transaction_modes:
+            raise ValueError("Unknown transaction mode %r." % transaction)
+
+        req = cherrypy.request
+        req.orm_transaction = transaction
+        req.orm_transaction_ended = False
+        req.orm_transaction_deferred = False
+        req.orm_session = _LazyScopedSession(
+            functools.partial(self._get_session_factory, bindings, commit_strategy))
+        if query_timing or slow_query_threshold is not None or server_timing:
+            _install_query_timers()
+            req.orm_query_stats = QueryStats(req.path_info, slow_query_threshold)
+            req.orm_server_timing = server_timing
+
+    def before_handler(self):
+        req = cherrypy.request
+        if req.orm_transaction == "explicit" or req.handler is None:
+            return
+
+        inner_handler = req.handler
+        session = req.orm_session
+        commit = req.orm_transaction == "commit"
+
+        def handler(*args, **kwargs):
+            succeeded = deferred = False
+            try:
+                body = inner_handler(*args, **kwargs)
+                succeeded = True
+                deferred = isinstance(body, collections.Iterator)
+            except cherrypy.HTTPRedirect:
+                succeeded = True
+                raise
+            finally:
+                if not deferred:
+                    _end_transaction(session, commit and succeeded)
+            if deferred:
+                req.orm_transaction_deferred = True
+                return _end_transaction_after(body, session, commit)
+            return body
+
+        req.handler = handler
+    # Wrap the handler before other tools, such as json_out, do, so the
+    # transaction ends before they process its output.
+    before_handler.priority = 20
+    before_handler.fixed_priority = True
 
     def before_finalize(self):
         req = cherrypy.request
         session = req.orm_session
-        session.remove()
+        # The body still needs the session, see _end_transaction_after.
+        if session._factory is not None and not req.orm_transaction_deferred:
+            session.remove()
+
+        stats = getattr(req, "orm_query_stats", None)
+        if stats is not None and req.orm_server_timing:
+            _add_server_timing(stats.server_timing())
+    before_finalize.failsafe = True
 
     def after_error_response(self):
         req = cherrypy.request
         session = req.orm_session
+        if session._factory is None:
+            return
 
         try:
-            session.rollback()
-            session.expunge_all()
+            # Rolling back a removed session would only set up a new one
+            if not req.orm_transaction_ended:
+                session.rollback()
+                session.expunge_all()
         except SQLAlchemyError as e:
             logger.error(e, exc_info=True)
             cherrypy.log.error(msg=e, severity=logging.ERROR, traceback=True)
         finally:
             session.remove()
+    after_error_response.failsafe = True
+
+    def on_end_request(self):
+        # Neither before_finalize nor after_error_response run for requests
+        # ending with an InternalRedirect, and the next request on this
+        # thread would get the same session otherwise.
+        session = getattr(cherrypy.request, "orm_session", None)
+        if session is not None and session._factory is not None:
+            session.remove()
+    on_end_request.failsafe = True
+
+
+_profile_filename = re.compile(r"^\d+-.+\.prof$")
+
+
+def _to_bytes(s):
+    return s if isinstance(s, bytes) else s.encode("utf-8")
+
+
+class ProfilerTool(MultiHookPointTool):
+    """A CherryPy tool to profile requests with `cProfile`.
+
+    The profile of a request starts at `on_start_resource` and ends at
+    `on_end_request`, so it covers the other tools as well as the handler.
+    It's dumped to a `pstats` file in the `on_start_resource.directory`
+    option, which defaults to the system's temporary directory. The files
+    can be read with `pstats`, or turned into flame graphs with the tools
+    that read `pstats` files. Only the `on_start_resource.max_profiles` most
+    recent profiles are kept in the directory, 100 by default, the older
+    ones are deleted as new ones are saved.
+
+    The `on_start_resource.sample_rate` option is the fraction of the
+    requests that are profiled, 1% by default. If the
+    `on_start_resource.header` and `on_start_resource.secret` options are
+    set, requests with that header set to that secret are always profiled,
+    so a sample rate of 0 profiles only the requests asking for it. Requests
+    that aren't profiled only pay for that decision.
+
+    Example::
+
+        cherrypy.tools.profiler = ProfilerTool()
+
+        app_config = {
+            "/": {
+                "tools.profiler.on": True,
+                "tools.profiler.on_start_resource.directory": "/var/tmp/profiles",
+                "tools.profiler.on_start_resource.sample_rate": 0,
+                "tools.profiler.on_start_resource.header": "X-Profile",
+                "tools.profiler.on_start_resource.secret": "..."
+            }
+        }
+    """
+
+    def on_start_resource(self, directory=None, sample_rate=0.01, header=None, secret=None,
+                          max_profiles=100):
+        req = cherrypy.request
+        requested = (header is not None and secret is not None and
+                     hmac.compare_digest(_to_bytes(req.headers.get(header, "")),
+                                         _to_bytes(secret)))
+        if not requested and random.random() >= sample_rate:
+            return
+
+        req.profiler_directory = directory or tempfile.gettempdir()
+        req.profiler_max_profiles = max_profiles
+        req.profiler_start = time.time()
+        req.profiler = cProfile.Profile()
+        req.profiler.enable()
+    # Profile as much of the request as possible.
+    on_start_resource.priority = 0
+
+    def on_end_request(self):
+        req = cherrypy.request
+        profiler = getattr(req, "profiler", None)
+        if profiler is None:
+            return
+        profiler.disable()
+        req.profiler = None
+
+        elapsed = time.time() - req.profiler_start
+        route = re.sub(r"[^A-Za-z0-9_.-]+", "_", req.path_info.strip("/"))[:100] or "index"
+        filename = "%d-%s-%s-%dms.prof" % (req.profiler_start * 1000000, req.method, route,
+                                          elapsed * 1000)
+        if not os.path.isdir(req.profiler_directory):
+            try:
+                os.makedirs(req.profiler_directory)
+            except OSError:
+                pass  # Created by another request meanwhile, or fails below
+        path = os.path.join(req.profiler_directory, filename)
+        try:
+            # Renamed once complete, so nothing reads half a profile.
+            profiler.dump_stats(path + ".tmp")
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            logger.error("Could not save the profile of %s: %s", req.path_info, e)
+        else:
+            self._remove_old_profiles(req.profiler_directory, req.profiler_max_profiles)
+    on_end_request.priority = 100
+    on_end_request.failsafe = True
+
+    def _remove_old_profiles(self, directory, max_profiles):
+        try:
+            profiles = [filename for filename in os.listdir(directory)
+                        if _profile_filename.match(filename)]
+        except OSError as e:
+            logger.error("Could not list the profiles in %s: %s", directory, e)
+            return
+
+        # The profiles' names start with the time they started at.
+        profiles.sort(key=lambda filename: int(filename.split("-", 1)[0]))
+        for filename in profiles[:max(len(profiles) - max_profiles, 0)]:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except OSError:
+                pass  # Removed by another request meanwhile
+
+
+class PhaseTimings(object):
+    """Histograms of how long each phase of the requests to each route took.
+
+    The buckets of the histograms are bounded by `buckets`, in seconds.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def record(self, route, phases):
+        """Record the durations of the `phases` of a request to `route`.
+
+        `phases` is a sequence of (phase, seconds) pairs.
+        """
+        with self._lock:
+            for phase, seconds in phases:
+                histogram = self._timings.get((route, phase))
+                if histogram is None:
+                    histogram = self._timings[(route, phase)] = Histogram(self.buckets)
+                histogram.add(seconds)
+
+    def snapshot(self):
+        """Return the timings so far as a dict of routes to dicts of phases."""
+        snapshot = {}
+        with self._lock:
+            for (route, phase), histogram in self._timings.items():
+                snapshot.setdefault(route, {})[phase] = {
+                    "count": histogram.count,
+                    "total": histogram.total,
+                    "max": histogram.max,
+                    "histogram": histogram.snapshot()}
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._timings.clear()
+
+
+class PhaseTimingStatus(JSONStatus):
+    """A controller serving the `PhaseTimings` of a `PhaseTimerTool` as JSON.
+
+    Example::
+
+        cherrypy.tree.mount(PhaseTimingStatus(cherrypy.tools.phase_timer.timings),
+                            "/status/timings")
+    """
+
+    def __init__(self, timings):
+        JSONStatus.__init__(self, timings.snapshot)
+        self.timings = timings
+
+
+def _route_name(handler):
+    callable_ = getattr(handler, "callable", handler)
+    name = getattr(callable_, "__name__", None) or type(callable_).__name__
+    owner = getattr(callable_, "__self__", None)
+    if owner is not None:
+        name = "%s.%s" % (type(owner).__name__, name)
+    return "%s.%s" % (getattr(callable_, "__module__", None) or type(owner).__module__, name)
+
+
+class PhaseTimerTool(MultiHookPointTool):
+    """A CherryPy tool timing the phases of requests.
+
+    Every hook point is timed from its first hook to its last, and named
+    after it. The stages CherryPy runs between the hook points are timed too:
+    "headers", "request_body", "handler", "error_response", "finalize" and
+    "write", the time it took to send the response. "total" is the time from
+    `on_start_resource` to `on_end_request`. So hooks like the ones loading
+    sessions at `before_handler` are told apart from the handler itself.
+
+    The timings are recorded in `timings`, a `PhaseTimings`, under the
+    handler of the request, and can be served by a `PhaseTimingStatus`. If
+    the `on_start_resource.server_timing` option is True, the phases over by
+    the time the response is finalized are also sent in a Server-Timing
+    response header, so "finalize", "write" and "total" are left out.
+
+    CherryPy handles unexpected errors after `on_end_resource`, so for those
+    requests "write" is timed from `after_error_response` on instead.
+
+    Example::
+
+        cherrypy.tools.phase_timer = PhaseTimerTool()
+
+        app_config = {
+            "/": {
+                "tools.phase_timer.on": True,
+                "tools.phase_timer.on_start_resource.server_timing": True
+            }
+        }
+    """
+
+    # The stage CherryPy runs after each hook point.
+    stages = {"on_start_resource": "headers",
+              "before_request_body": "request_body",
+              "before_handler": "handler",
+              "before_error_response": "error_response",
+              "after_error_response": "write",
+              "before_finalize": "finalize",
+              "on_end_resource": "write"}
+
+    def __init__(self, name=None, priority=0, timings=None):
+        MultiHookPointTool.__init__(self, name, priority)
+        self.timings = timings if timings is not None else PhaseTimings()
+
+    def _setup(self):
+        MultiHookPointTool._setup(self)
+        hooks = cherrypy.request.hooks
+        for hook_point, stage in self.stages.items():
+            hooks.attach(hook_point, functools.partial(self._mark, stage),
+                         failsafe=True, priority=100)
+        # After the marks above, and right before the response is finalized.
+        for hook_point in ("before_finalize", "after_error_response"):
+            hooks.attach(hook_point, self._set_server_timing, failsafe=True, priority=100)
+
+    def _mark(self, phase):
+        cherrypy.request.phase_marks.append((phase, time.time()))
+
+    def _phases(self, marks):
+        phases = {}
+        for (phase, start), (_, end) in zip(marks, marks[1:]):
+            phases[phase] = phases.get(phase, 0.0) + end - start
+        return phases
+
+    def _set_server_timing(self):
+        req = cherrypy.request
+        if getattr(req, "phase_server_timing", False):
+            _add_server_timing(", ".join(
+                "%s;dur=%.3f" % (phase, seconds * 1000)
+                for phase, seconds in sorted(self._phases(req.phase_marks).items())))
+
+    def on_start_resource(self, server_timing=False):
+        req = cherrypy.request
+        req.phase_marks = [("on_start_resource", time.time())]
+        req.phase_server_timing = server_timing
+        req.phase_route = None
+
+    def before_request_body(self):
+        self._mark("before_request_body")
+
+    def before_handler(self):
+        req = cherrypy.request
+        self._mark("before_handler")
+        # Before other tools wrap the handler
+        if req.handler is not None:
+            req.phase_route = _route_name(req.handler)
+
+    def before_error_response(self):
+        marks = getattr(cherrypy.request, "phase_marks", None)
+        # Nothing has been written yet when an unexpected error is handled.
+        if marks and marks[-1][0] == "write":
+            marks.pop()
+        self._mark("before_error_response")
+
+    def after_error_response(self):
+        self._mark("after_error_response")
+
+    def before_finalize(self):
+        self._mark("before_finalize")
+
+    def on_end_resource(self):
+        self._mark("on_end_resource")
+
+    def on_end_request(self):
+        req = cherrypy.request
+        marks = getattr(req, "phase_marks", None)
+        if not marks:
+            return
+        self._mark("on_end_request")
+        phases = self._phases(marks)
+        phases["total"] = marks[-1][1] - marks[0][1]
+        self.timings.record(req.phase_route or "(no handler)", phases.items())
+    on_end_request.failsafe = True
@@ -4,19 +4,19 @@ import hmac
 import logging
 import sys
 import textwrap
+import threading
 
 from base64 import b64encode, urlsafe_b64encode
-
-try:
-    import simplejson as json
-except ImportError:
-    import json
+from collections import OrderedDict
 
 from datetime import date, time, datetime, timedelta
 
 from dateutil.parser import parse as parse_date
 
+from blueberrypy import jsonlib
+
 try:
+    from sqlalchemy import and_, or_, inspect as sqlalchemy_inspect
     from sqlalchemy.orm import RelationshipProperty, Session, collections
 except ImportError:
     sqlalchemy_support = False
@@ -75,7 +75,8 @@ def _ensure_is_dict(key, inc_exc):
     return {}
 
 
-def to_collection(from_, includes=None, excludes=None, format=None, recursive=False, **json_kwargs):
+def to_collection(from_, includes=None, excludes=None, format=None, recursive=False, stream=False,
+                  **json_kwargs):
     """Convert complex values and SQLAlchemy declarative model objects to a Python collections.
 
     This function generally works very similar to `json.dump()`, with the
@@ -115,7 +116,8 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
 
     Internally, `to_collection()` will convert the provided `includes` and
     `excludes` property sets to a mapping of the classes of the values to lists
-    of property key strings.
+    of property key strings. The list of attributes to serialize is computed
+    once per model class and property sets, and cached for subsequent calls.
 
     **Note:** Mapped property names starting with '_' will never be included in the
     returned result.
@@ -145,8 +147,15 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
     If `format` is the string `json`, the result returned will be a JSON string
     , otherwise a Python collection object will be returned.
 
-    If any `json_kwargs` is provided, they will be passed through to the
-    underlying simplejson JSONDecoder.
+    If `stream` is True, `format` must be `json` and a generator yielding the
+    JSON string in chunks is returned instead. If `from_` is a collection (a
+    `Query` for example), its elements are converted and encoded one at a time
+    so the entire result never has to be held in memory. This is suitable to
+    return from a CherryPy handler with `response.stream` turned on. To keep
+    memory usage flat for large queries, consider using `Query.yield_per()`.
+
+    If any `json_kwargs` is provided, they will be passed through to
+    `blueberrypy.jsonlib.dumps()`.
 
     Examples:
     ---------
@@ -159,11 +168,133 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
     >>> to_collection(legco, excludes='founded', format='json') #doctest: +SKIP
     '{"name": "Hong Kong Legislative Council Building", 'location': {'type': 'Point', 'coordinates': [22.280909, 114.160349]}}'
 
+    >>> list(to_collection([legco, hkpark], recursive=True, excludes='location', format='json', stream=True)) #doctest: +SKIP
+    ['[{"name": "Hong Kong Legislative Council Building", "founded": {"date": "1912-01-15"}}, {"name": "Hong Kong Park", "founded": {"date": "1991-05-23"}}]']
+
     >>> to_collection([legco, hkpark], recursive=True, included={Location: set(['founded'])}) #doctest: +SKIP
     [{'name': 'Hong Kong Legislative Council Building', 'founded': {'date': '1912-01-15'}, 'location': {'type': 'Point', 'coordinates': (22.280909, 114.160349)}},
     {'name': 'Hong Kong Park', 'founded': {'date': '1991-05-23'}, 'location': {'type': 'Point', 'coordinates': [22.2771398, 114.1613993]}}]
 
     """
+    # mappings don't depend on the class of the values, so they can be bound
+    # once up front instead of once per model object
+    if isinstance(includes, dict):
+        includes = _BoundPropertySets.bind(None, includes)
+    if isinstance(excludes, dict):
+        excludes = _BoundPropertySets.bind(None, excludes)
+
+    if stream:
+        if format != "json":
+            raise ValueError("stream is only supported when format is 'json'.")
+        return _iter_json_chunks(from_, includes, excludes, recursive, json_kwargs)
+
+    result = _to_collection(from_, includes, excludes, recursive)
+
+    if format == "json":
+        return jsonlib.dumps(result, **json_kwargs)
+
+    return result
+
+
+class _BoundPropertySets(frozenset):
+    """An immutable, hashable mapping of model classes to property key sets.
+
+    This is the form `includes` and `excludes` take once they have been bound
+    to the class of the first model object encountered. It is a frozenset of
+    `(class, frozenset(keys))` pairs so it can be used as part of a
+    serialization plan cache key.
+    """
+
+    @classmethod
+    def bind(cls, key, inc_exc):
+        if isinstance(inc_exc, cls):
+            return inc_exc
+
+        if not inc_exc:
+            return cls()
+        elif isinstance(inc_exc, (str, basestring)):
+            return cls([(key, frozenset([inc_exc]))])
+        elif isinstance(inc_exc, (list, tuple, set, frozenset)):
+            return cls([(key, frozenset(inc_exc))])
+        elif isinstance(inc_exc, dict):
+            return cls(((k, frozenset([v] if isinstance(v, (str, basestring)) else v))
+                        for k, v in inc_exc.viewitems()))
+
+        raise TypeError(inc_exc, "Please provide a string, an iterable or a dict")
+
+    def to_dict(self):
+        return dict(((k, set(v)) for k, v in self))
+
+
+_SCALAR_TYPES = frozenset((type(None), bool, int, long, float, str, unicode))
+
+# The plans are kept in a least recently used cache, as includes and excludes
+# may come from the request, such as a list of fields to return.
+SERIALIZATION_PLAN_CACHE_SIZE = 256
+
+_serialization_plans = OrderedDict()
+_serialization_plans_lock = threading.Lock()
+
+
+class _SerializationPlan(object):
+    """A precompiled list of the attributes to serialize for a model class.
+
+    Plans are built once per `(model class, includes, excludes, recursive)`
+    combination by `_get_serialization_plan()` and are then applied to every
+    instance of that class with a flat attribute getter loop.
+    """
+
+    __slots__ = ("attrs", "includes", "excludes", "recursive")
+
+    def __init__(self, model_cls, includes, excludes, recursive):
+        excludes_dict = excludes.to_dict()
+
+        props = _get_model_properties(model_cls, excludes_dict, recursive=recursive)
+        attrs = set(props.viewkeys())
+        if includes:
+            for k, v in includes:
+                if k is model_cls:
+                    attrs |= v
+        if excludes_dict and model_cls in excludes_dict:
+            attrs -= excludes_dict[model_cls]
+
+        # iterate the attrs in the same order as the set they are built from
+        # so results are identical to converting each instance one by one
+        self.attrs = tuple((attr for attr in attrs if not attr.startswith("_")))
+        self.includes = includes
+        # backrefs found while building the plan are excluded from descendants
+        self.excludes = _BoundPropertySets.bind(model_cls, excludes_dict)
+        self.recursive = recursive
+
+    def apply(self, obj):
+        includes, excludes, recursive = self.includes, self.excludes, self.recursive
+        result = {}
+        for attr in self.attrs:
+            val = getattr(obj, attr)
+            if type(val) in _SCALAR_TYPES:
+                result[attr] = val
+            else:
+                result[attr] = _to_collection(val, includes, excludes, recursive)
+        return result
+
+
+def _get_serialization_plan(model_cls, includes, excludes, recursive):
+    key = (model_cls, includes, excludes, recursive)
+    with _serialization_plans_lock:
+        plan = _serialization_plans.pop(key, None)
+        if plan is not None:
+            _serialization_plans[key] = plan
+            return plan
+
+    plan = _SerializationPlan(model_cls, includes, excludes, recursive)
+    with _serialization_plans_lock:
+        _serialization_plans[key] = plan
+        while len(_serialization_plans) > SERIALIZATION_PLAN_CACHE_SIZE:
+            _serialization_plans.popitem(last=False)
+    return plan
+
+
+def _to_collection(from_, includes, excludes, recursive):
     if hasattr(from_, "__mapper__"):
 
         if not sqlalchemy_support:
@@ -174,22 +305,12 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
             $ pip install sqlalchemy
             """))
 
-        includes = _ensure_is_dict(from_.__class__, includes)
-        excludes = _ensure_is_dict(from_.__class__, excludes)
-
-        props = _get_model_properties(from_, excludes, recursive=recursive)
-        attrs = set(props.viewkeys())
-        if includes and from_.__class__ in includes:
-            attrs |= includes[from_.__class__]
-        if excludes and from_.__class__ in excludes:
-            attrs -= excludes[from_.__class__]
-
-        result = {}
-        for attr in attrs:
-            if not attr.startswith("_"):
-                val = getattr(from_, attr)
-                val = to_collection(val, includes=includes, excludes=excludes, recursive=recursive)
-                result[attr] = val
+        model_cls = from_.__class__
+        plan = _get_serialization_plan(model_cls,
+                                       _BoundPropertySets.bind(model_cls, includes),
+                                       _BoundPropertySets.bind(model_cls, excludes),
+                                       bool(recursive))
+        result = plan.apply(from_)
     else:
         if isinstance(from_, datetime):
             result = {"datetime": from_.isoformat()}
@@ -204,21 +325,31 @@ def to_collection(from_, includes=None, excludes=None, format=None, recursive=Fa
         elif isinstance(from_, dict):
             result = {}
             for k, v in from_.items():
-                result[unicode(k)] = to_collection(v, includes=includes, excludes=excludes,
-                                                   recursive=recursive)
+                result[unicode(k)] = _to_collection(v, includes, excludes, recursive)
         # iterable collections, not strings
         elif iterable(from_) and not isinstance(from_, (str, basestring, bytes, bytearray)):
-            result = [to_collection(v, includes=includes, excludes=excludes, recursive=recursive)
+            result = [_to_collection(v, includes, excludes, recursive)
                       for v in from_] if recursive else list(from_)
         else:
             result = from_
 
-    if format == "json":
-        return json.dumps(result, **json_kwargs)
-
     return result
 
 
+def _iter_json_chunks(from_, includes, excludes, recursive, json_kwargs):
+    if (hasattr(from_, "__mapper__") or isinstance(from_, dict) or not iterable(from_) or
+            isinstance(from_, (str, basestring, bytes, bytearray))):
+        return jsonlib.dump_chunks(_to_collection(from_, includes, excludes, recursive),
+                                   **json_kwargs)
+
+    if recursive:
+        from_ = (_to_collection(v, includes, excludes, recursive) for v in from_)
+    else:
+        from_ = iter(from_)
+
+    return jsonlib.dump_chunks(from_, **json_kwargs)
+
+
 def _get_property_instance(session, mapping, prop):
     prop_cls = prop.mapper.class_
     prop_pk_vals = tuple((mapping[pk_col.key]
@@ -234,6 +365,125 @@ def _get_property_instance(session, mapping, prop):
     return prop_inst
 
 
+_PREFETCH_BATCH_SIZE = 500
+
+
+def _get_primary_key_values(mapping, mapper):
+    pk_vals = []
+    for pk_col in mapper.primary_key:
+        val = mapping.get(pk_col.key)
+        if val is None:
+            return None
+        pk_vals.append(val)
+
+    pk_vals = tuple(pk_vals)
+    try:
+        hash(pk_vals)
+    except TypeError:
+        return None
+    return pk_vals
+
+
+def _load_property_instances(session, mapper, pks):
+    loaded = {}
+    missing = []
+
+    identity_map = session.identity_map
+    for pk in pks:
+        inst = identity_map.get(mapper.identity_key_from_primary_key(pk))
+        if inst is not None and not sqlalchemy_inspect(inst).expired:
+            loaded[pk] = inst
+        else:
+            missing.append(pk)
+
+    pk_cols = mapper.primary_key
+    for i in range(0, len(missing), _PREFETCH_BATCH_SIZE):
+        batch = missing[i:i + _PREFETCH_BATCH_SIZE]
+        if len(pk_cols) == 1:
+            criterion = pk_cols[0].in_([pk[0] for pk in batch])
+        else:
+            criterion = or_(*[and_(*[col == val for col, val in zip(pk_cols, pk)])
+                              for pk in batch])
+        for inst in session.query(mapper.class_).filter(criterion):
+            loaded[tuple(mapper.primary_key_from_instance(inst))] = inst
+
+    return loaded
+
+
+def _prefetch_property_instances(from_, to_, excludes=None):
+    """Load all the persisted relationship instances referenced in `from_`.
+
+    The mappings in `from_` are walked one level of relationships at a time,
+    and the primary keys found on each level are loaded with one `IN` query per
+    mapper. The instances are put into the session's identity map, so the
+    subsequent `session.query().get()` calls in `_get_property_instance()`
+    won't have to go to the database. The relationships `_from_collection()`
+    skips because of `excludes` are not prefetched. The loaded instances are
+    returned so the caller can hold on to them.
+    """
+    if not sqlalchemy_support:
+        return []
+
+    if isinstance(from_, dict):
+        pairs = [(from_, to_)]
+    elif (iterable(from_) and not isinstance(from_, (str, basestring, bytes, bytearray)) and
+          iterable(to_) and not isinstance(to_, (str, basestring, bytes, bytearray))):
+        pairs = zip(from_, to_)
+    else:
+        return []
+
+    excludes = _ensure_is_dict(to_.__class__, excludes)
+
+    frontiers = {}
+    for mapping, inst in pairs:
+        if isinstance(mapping, dict) and hasattr(inst, "__mapper__"):
+            session = Session.object_session(inst)
+            if session is not None:
+                frontiers.setdefault(session, []).append((mapping, inst.__mapper__))
+
+    prefetched = []
+    for session, frontier in frontiers.viewitems():
+        while frontier:
+            children, pending = [], {}
+            for mapping, mapper in frontier:
+                # adds the backrefs to the excludes, as _from_collection() does
+                _get_model_properties(mapper.class_, excludes, recursive=True)
+                excluded = excludes.get(mapper.class_, ())
+                for prop in mapper.relationships:
+                    if prop.key not in mapping or prop.key in excluded:
+                        continue
+
+                    val = mapping[prop.key]
+                    if prop.uselist is None or prop.uselist:
+                        if isinstance(val, list):
+                            vals = val
+                        elif isinstance(val, dict):
+                            vals = val.viewvalues()
+                        else:
+                            continue
+                    else:
+                        vals = [val]
+
+                    for v in vals:
+                        if isinstance(v, dict):
+                            pk = _get_primary_key_values(v, prop.mapper)
+                            if pk is not None:
+                                pending.setdefault(prop.mapper, set()).add(pk)
+                            children.append((v, prop.mapper, pk))
+
+            loaded = {}
+            for mapper, pks in pending.viewitems():
+                loaded[mapper] = _load_property_instances(session, mapper, pks)
+                prefetched.extend(loaded[mapper].viewvalues())
+
+            frontier = []
+            for v, mapper, pk in children:
+                inst = loaded.get(mapper, {}).get(pk)
+                frontier.append((v, inst.__mapper__ if inst is not None else mapper))
+
+    return prefetched
+
+
 def iterable(param):
     try:
         iter(param)
@@ -283,11 +533,22 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
     with a form validation library will be provided to ease this process.
     """
     if format == "json":
-        from_ = json.loads(from_)
+        from_ = jsonlib.loads(from_)
 
     if collection_handling not in ["replace", "append"]:
         raise ValueError("collection_handling must be 'replace' or 'append'.")
 
+    # The session's identity map only holds weak references, so this list is
+    # what keeps the prefetched instances in it until they've been assigned.
+    prefetched = _prefetch_property_instances(from_, to_, excludes)
+    to_ = _from_collection(from_, to_, excludes=excludes,
+                           collection_handling=collection_handling)
+    del prefetched
+    return to_
+
+
+def _from_collection(from_, to_, excludes=None, collection_handling="replace"):
+
     excludes = _ensure_is_dict(to_.__class__, excludes)
 
     if to_ is None:
@@ -297,7 +558,7 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
         if isinstance(to_, dict):
             for k in to_.viewkeys():
                 if k in from_:
-                    to_[k] = from_collection(from_[k], to_[k], excludes=excludes)
+                    to_[k] = _from_collection(from_[k], to_[k], excludes=excludes)
         elif hasattr(to_, "__mapper__"):
 
             if not sqlalchemy_support:
@@ -338,17 +599,17 @@ def from_collection(from_, to_, excludes=None, format=None, collection_handling=
                             for v in from_iterator:
                                 prop_inst = _get_property_instance(Session.object_session(to_), v,
                                                                    prop)
-                                appender(from_collection(v, prop_inst, excludes=excludes))
+                                appender(_from_collection(v, prop_inst, excludes=excludes))
 
                             if collection_handling == "replace":
                                 setattr(to_, attr, col)
                         else:
                             prop_inst = _get_property_instance(Session.object_session(to_),
                                                                from_val, prop)
-                            setattr(to_, attr, from_collection(from_val, prop_inst,
-                                                               excludes=excludes))
+                            setattr(to_, attr, _from_collection(from_val, prop_inst,
+                                                                excludes=excludes))
                     else:
-                        setattr(to_, attr, from_collection(from_val, None, excludes=excludes))
+                        setattr(to_, attr, _from_collection(from_val, None, excludes=excludes))
         else:
             if "date" in from_:
                 to_ = parse_date(from_["date"]).date()